@@ -0,0 +1,150 @@
+from model import *
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import tracemalloc
+
+
+# Scaling benchmarks
+#
+#   python bench.py --agents 1000 10000 100000 --engine numpy --out bench.json
+#
+# Every run builds a synthetic scenario and times each phase on its own:
+# populate, constrain, sched (Schedule.sched) and steady-state step
+# throughput in agent-steps per second. Peak memory is the process peak RSS
+# after each phase; --trace-memory adds tracemalloc peaks per phase (slower).
+# population_bytes_per_agent is the size of the Population arrays per agent.
+# Results are written as JSON so runs can be compared over time.
+
+
+def scenario(agents, classes=4, activities=8, days=7, hours=24, density=0.5, seed=0):
+    # Synthetic scenario description
+    # Each class has a default activity and constrains a `density` share of
+    # its (day, hour) slots to randomly chosen activities
+    rng = random.Random(seed)
+    week = days * hours
+    acts = {}
+    for i in range(activities):
+        acts["act" + str(i)] = (rng.choice([2, 5, 20, 60]), round(rng.uniform(0.01, 0.5), 3))
+    names = list(acts)
+    population = {}
+    for i in range(classes):
+        population["class" + str(i)] = (names[i % activities], agents // classes + (1 if i < agents % classes else 0))
+    constraints = []
+    for name in population:
+        for day in range(days):
+            for hour in range(hours):
+                if rng.random() < density:
+                    constraints += [(name, rng.choice(names), day, hour)]
+    return {
+        "calendar": (days, hours),
+        "compartments": {
+            "S": ([("I", "I", 0.03)], None),
+            "I": ([], ("R", week)),
+            "R": ([], ("S", week * 2)),
+        },
+        "activities": acts,
+        "classes": population,
+        "constraints": constraints,
+    }
+
+
+def phase(results, name, trace, f, *args):
+    # run f(*args), recording wall time and memory under results[name]
+    if trace:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        out = f(*args)
+    results[name] = {"seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss()}
+    if trace:
+        results[name]["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    return out
+
+
+def peak_rss():
+    # peak resident set size of this process so far, in MB
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def run(agents, engine="numpy", steps=168, warmup=24, infect=0.01, seed=0, trace=False, **params):
+    # build a synthetic scenario and time every phase
+    spec = scenario(agents, seed=seed, **params)
+    model = SchedModel(Calendar(*spec["calendar"]), engine=engine, seed=seed)
+    model.compartments(spec["compartments"])
+    model.activity_list(spec["activities"])
+
+    phases = {}
+    if trace:
+        tracemalloc.start()
+    phase(phases, "populate", trace, model.populate, spec["classes"])
+    phase(phases, "constrain", trace, model.constrain, spec["constraints"])
+    phase(phases, "sched", trace, model.sched, False)
+
+    # steady state: seed an outbreak, let it settle, then time plain steps
+    model.infect(max(1, int(agents * infect)), "I")
+    for i in range(warmup):
+        model.step()
+    phase(phases, "step", trace, lambda: [model.step() for i in range(steps)])
+    if trace:
+        tracemalloc.stop()
+
+    return {
+        "params": dict(agents=agents, engine=engine, steps=steps, warmup=warmup, infect=infect, seed=seed, **params),
+        "phases": phases,
+        "sites": len(model.world.sites),
+        "population_bytes_per_agent": model.population.nbytes() / agents,
+        "agent_steps_per_second": agents * steps / phases["step"]["seconds"],
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time populate, constrain, sched and step on synthetic scenarios")
+    parser.add_argument("--agents", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--engine", choices=["mesa", "numpy"], default="numpy")
+    parser.add_argument("--classes", type=int, default=4)
+    parser.add_argument("--activities", type=int, default=8)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--density", type=float, default=0.5, help="share of each class's slots that are constrained")
+    parser.add_argument("--steps", type=int, default=168, help="steps timed for throughput")
+    parser.add_argument("--warmup", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="also record tracemalloc peaks per phase")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for agents in args.agents:
+        # each size runs in a fresh process so peak memory is its own
+        with multiprocessing.get_context("spawn").Pool(1) as worker:
+            runs += [worker.apply(run, kwds=dict(
+                agents=agents, engine=args.engine, steps=args.steps, warmup=args.warmup, seed=args.seed, trace=args.trace_memory,
+                classes=args.classes, activities=args.activities, days=args.days, hours=args.hours, density=args.density))]
+        print(str(agents) + " agents: " + ", ".join([name + " " + "%.3fs" % p["seconds"] for name, p in runs[-1]["phases"].items()]), file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from model import *
+import hashlib
+import itertools
+import multiprocessing
+
+
+# Replicate runs of one scenario
+#
+# Build and sched() the model once, then
+#
+#   runs = ensemble(model, 200, WEEK * 10, seed=1, infect=[(3, "I")])
+#   runs.mean(), runs.quantiles([0.05, 0.5, 0.95])
+#
+# Workers are forked from the calling process, so each one starts from the
+# already computed Schedule instead of rerunning sched()
+#
+# Parameter sweeps run every combination of a grid of values the same way:
+#
+#   grid = {"transmission.bus": [0.1, 0.25], "transition.S.I.I": [0.01, 0.03], "infect.I": [1, 5]}
+#   points = sweep(model, grid, WEEK * 10, replicates=20, seed=1, infect=[(3, "I")])
+#
+# Grid keys:
+#   transmission.<activity>                 Activity.transmission
+#   transition.<state>.<trigger>.<target>   probability of a transition in the compartment model
+#   evolution.<state>                       duration of a state's evolution
+#   infect.<state>                          agents seeded in that state at the start
+#   capacity.<activity>                     Activity.capacity; the only key that needs sched() again
+# Only capacity changes site assignment. Points are ordered so that capacity
+# values change slowest and a worker reschedules only when they change;
+# without capacity keys every point reuses the schedule it was forked with
+
+
+class Ensemble():
+    # Compartment counts of a set of replicate runs
+
+    def __init__(self, states, seeds, counts):
+        self.states = states    # state ids, in column order
+        self.seeds = seeds      # seed of each replicate
+        self.counts = counts    # (replicates x steps x states)
+
+    def mean(self):
+        # (steps x states) mean over replicates
+        return self.counts.mean(axis=0)
+
+    def quantiles(self, q=(0.05, 0.5, 0.95)):
+        # (len(q) x steps x states) quantiles over replicates
+        return np.quantile(self.counts, q, axis=0)
+
+    def summary(self, q=(0.05, 0.5, 0.95)):
+        # per state: mean and quantile series over time
+        mean = self.mean()
+        quantiles = self.quantiles(q)
+        return {state: {"mean": mean[:, i], "quantiles": dict(zip(q, quantiles[:, :, i]))} for i, state in enumerate(self.states)}
+
+
+def seeds(seed, replicates):
+    # independent, reproducible seeds, one per replicate
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(replicates)]
+
+
+class Sweep():
+    # Compartment counts of replicate runs at every point of a parameter grid
+
+    def __init__(self, points, states, seeds, counts):
+        self.points = points    # one {key: value} dict per grid point
+        self.states = states
+        self.seeds = seeds      # replicate seeds, shared by all points
+        self.counts = counts    # (points x replicates x steps x states)
+
+    def ensemble(self, i):
+        # the replicates of point i
+        return Ensemble(self.states, self.seeds, self.counts[i])
+
+    def mean(self):
+        # (points x steps x states) mean over replicates
+        return self.counts.mean(axis=1)
+
+
+def grid_points(grid):
+    # every combination of the grid's values, capacity keys varying slowest
+    keys = sorted(grid, key=lambda key: key.split(".")[0] != "capacity")
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def get(model, key):
+    # current value of a grid key
+    kind, *names = key.split(".")
+    if kind == "transmission":
+        return model.activities[names[0]].transmission
+    if kind == "capacity":
+        return model.activities[names[0]].capacity
+    if kind == "evolution":
+        return model.contagion.by_id[names[0]].evolution[1]
+    if kind == "transition":
+        state, trigger, target = names
+        return [w for (u,v,w) in model.contagion.by_id[state].transitions if u == trigger and v == target][0]
+    raise ValueError("Unknown sweep parameter " + key)
+
+
+def configure(model, point, seed, infect):
+    # set model up for one grid point; returns the seeding to use
+    infect = dict([(state_id, N) for (N, state_id) in infect])
+    capacities = {key: value for key, value in point.items() if key.startswith("capacity.")}
+    if capacities and getattr(model.schedule, "capacities", None) != capacities:
+        # each capacity combination gets its own schedule, drawn from a seed
+        # that depends only on the combination, whichever worker builds it
+        for key, value in capacities.items():
+            model.set_capacity(key.split(".")[1], value)
+        combination = str((seed, sorted(capacities.items()))).encode()
+        model.streams.seed(int(hashlib.sha256(combination).hexdigest(), 16), ["schedule"])
+        model.sched(show=False)
+        model.schedule.capacities = capacities
+    for key, value in point.items():
+        kind, *names = key.split(".")
+        if kind == "transmission":
+            model.set_transmission(names[0], value)
+        elif kind == "transition":
+            model.set_transition(*names, value)
+        elif kind == "evolution":
+            model.set_evolution(names[0], value)
+        elif kind == "infect":
+            infect[names[0]] = value
+        elif kind != "capacity":
+            raise ValueError("Unknown sweep parameter " + key)
+    return [(N, state_id) for state_id, N in infect.items()]
+
+
+def replicate(model, seed, steps, infect):
+    # one run from step 0
+    model.reset(seed)
+    for (N, state_id) in infect:
+        model.infect(N, state_id)
+    model.forward(steps)
+    return model.trajectory().copy()
+
+
+# The model each worker process runs; set before the pool forks
+shared = None
+
+def load(model):
+    global shared
+    shared = model
+
+def work(job):
+    return replicate(shared, *job)
+
+def work_point(job):
+    (point, sweep_seed, seed, steps, infect) = job
+    return replicate(shared, seed, steps, configure(shared, point, sweep_seed, infect))
+
+
+def pool(model, processes):
+    # worker processes holding a copy of model
+    # fork shares the parent's model copy-on-write; elsewhere it is pickled once per worker
+    if "fork" in multiprocessing.get_all_start_methods():
+        load(model)
+        return multiprocessing.get_context("fork").Pool(processes)
+    return multiprocessing.Pool(processes, initializer=load, initargs=(model,))
+
+
+def ensemble(model, replicates, steps, seed=None, processes=None, infect=[]):
+    # run `replicates` independent copies of a scheduled model for `steps` steps
+    # infect is a list of (N, state_id) seedings applied at the start of every run
+    # processes=1 runs in this process, on model itself
+    S = seeds(seed, replicates)
+    jobs = [(s, steps, infect) for s in S]
+    if processes == 1:
+        counts = [replicate(model, *job) for job in jobs]
+    else:
+        with pool(model, processes) as workers:
+            counts = workers.map(work, jobs)
+    return Ensemble([state.id for state in model.contagion.states], S, np.stack(counts))
+
+
+def sweep(model, grid, steps, replicates=1, seed=None, processes=None, infect=[]):
+    # run `replicates` copies of a scheduled model at every combination of grid values
+    # replicate i uses the same seed at every point, so points differ only by their parameters
+    # processes=1 runs in this process and puts model back to its starting values afterwards
+    # (swept capacities are put back by rescheduling, so the site assignment is redrawn)
+    points = grid_points(grid)
+    S = seeds(seed, replicates)
+    jobs = [(point, seed, s, steps, infect) for point in points for s in S]
+    if processes == 1:
+        base = {key: get(model, key) for key in grid if not key.startswith("infect.")}
+        counts = [replicate(model, s, steps, configure(model, point, seed, infect)) for (point, seed, s, steps, infect) in jobs]
+        configure(model, base, seed, [])
+    else:
+        with pool(model, processes) as workers:
+            counts = workers.map(work_point, jobs, chunksize=max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count()))))
+    counts = np.stack(counts).reshape((len(points), replicates) + counts[0].shape)
+    return Sweep(points, [state.id for state in model.contagion.states], S, counts)
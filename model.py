@@ -1,8 +1,16 @@
-from mesa import Agent, Model
+from mesa import Model
 from mesa.time import SimultaneousActivation
+from collections.abc import Mapping
 from math import ceil
 import time
-import random
+import gc
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import numpy as np
 import matplotlib.pyplot as plt
 
 
@@ -26,6 +34,45 @@ class Contagion():
 
     def __init__(self,states):
         self.states = states
+        self.compile()
+
+    def compile(self):
+        # number the states and resolve every transition to State objects
+        # so stepping never has to search self.states by id
+        self.by_id = {}
+        self.index = {}
+        for i, state in enumerate(self.states):
+            state.index = i
+            self.by_id[state.id] = state
+            self.index[state.id] = i
+
+        for state in self.states:
+            # triggers: indices of the states of neighbors this state reacts to
+            # rules[trigger index]: list of (target State, probability), in declaration order
+            state.triggers = set([self.index[u] for (u,v,w) in state.transitions])
+            state.rules = {}
+            for (u,v,w) in state.transitions:
+                state.rules.setdefault(self.index[u], []).append((self.by_id[v], w))
+            state.next = self.by_id[state.evolution[0]] if state.evolution is not None else None
+
+        # indices of states that some state reacts to, and of the states that
+        # are one or will evolve into one
+        self.transmitting = sorted(set([u for state in self.states for u in state.triggers]))
+        self.spreading = []
+        for state in self.states:
+            seen = set()
+            S = state
+            while S is not None and S.index not in seen:
+                if S.index in self.transmitting:
+                    self.spreading += [state.index]
+                    break
+                seen.add(S.index)
+                S = S.next
+
+        # evolution: duration spent in a state before moving on, and the state moved to
+        self.evolves = np.array([state.evolution is not None for state in self.states], dtype=bool)
+        self.duration = np.array([state.evolution[1] if state.evolution else 0 for state in self.states], dtype=np.int64)
+        self.evolve_to = np.array([state.next.index if state.next else state.index for state in self.states], dtype=np.int32)
 
 
 class Calendar():
@@ -37,96 +84,568 @@ class Calendar():
 
 
 class Log():
-    # Object for agents to log activity
+    # Event recorder shared by the whole model
+    # Events are kept column-wise in numpy arrays: step, agent, event, src, dst, site
+    # (src/dst are state indices, site is a site index or -1)
+    #
+    # level 0 records nothing, 1 records state transitions, 2 also records
+    # every agent's state and site every hour
+    # When the buffer is full, the log
+    #   flushes it to path (.csv is appended to, .npz is written in numbered chunks) if a path is given,
+    #   otherwise drops the oldest rows if ring is True,
+    #   otherwise doubles the buffer
+    # so the default Log(model) keeps every transition of a run in memory; give it a
+    # path or ring=True to bound it (SchedModel.run bounds it for runs without history)
+
+    SEED, INFECTION, EVOLUTION, STATE = 0, 1, 2, 3
+    EVENTS = ["seed", "infection", "evolution", "state"]
+    LEVELS = [1, 1, 1, 2]
+    COLUMNS = {"step": np.int64, "agent": np.int32, "event": np.int8, "src": np.int16, "dst": np.int16, "site": np.int32}
+
+    def __init__(self, model, level=1, capacity=4096, ring=False, path=None):
+        self.model = model
+        self.level = level
+        self.capacity = capacity
+        self.ring = ring
+        self.path = path
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.start = 0      # oldest row, when the ring has wrapped
+        self.size = 0       # rows held in memory
+        self.dropped = 0    # rows lost to the ring
+        self.flushed = 0    # rows written to path
+        self.chunks = 0
+
+    def add(self, event, agent, src, dst, site=-1):
+        # record one event at the current step
+        if self.level < self.LEVELS[event]:
+            return
+        if self.size == self.capacity:
+            self.make_room(1)
+        i = (self.start + self.size) % self.capacity
+        row = (self.model.steps, agent, event, src, dst, site)
+        for column, value in zip(self.columns.values(), row):
+            column[i] = value
+        self.size += 1
+
+    def add_many(self, event, agents, src, dst, site):
+        # record one event for each of a batch of agents (arrays of equal length)
+        if self.level < self.LEVELS[event] or len(agents) == 0:
+            return
+        k = len(agents)
+        rows = {"step": np.full(k, self.model.steps), "agent": agents, "event": np.full(k, event), "src": src, "dst": dst, "site": site}
+        if self.size + k > self.capacity:
+            if self.path is not None and k > self.capacity:
+                self.flush()
+                self.save(rows, k)
+                return
+            if self.ring and k >= self.capacity:
+                self.dropped += self.size + k - self.capacity
+                rows = {name: values[k - self.capacity:] for name, values in rows.items()}
+                self.start, self.size, k = 0, 0, self.capacity
+            else:
+                self.make_room(k)
+        i = (self.start + self.size + np.arange(k)) % self.capacity
+        for name, column in self.columns.items():
+            column[i] = rows[name]
+        self.size += k
+
+    def make_room(self, k):
+        # free space for k more rows
+        if self.path is not None:
+            self.flush()
+        elif self.ring:
+            overflow = self.size + k - self.capacity
+            self.start = (self.start + overflow) % self.capacity
+            self.size -= overflow
+            self.dropped += overflow
+        else:
+            held = self.entries()
+            while self.capacity < self.size + k:
+                self.capacity *= 2
+            self.columns = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+            for name, column in self.columns.items():
+                column[:self.size] = held[name]
+            self.start = 0
+
+    def take(self):
+        # remove and return the rows held in memory, oldest first
+        # (unlike clear(), rows already written to path stay there)
+        rows = self.entries()
+        self.start = 0
+        self.size = 0
+        return rows
+
+    def clear(self):
+        # forget everything recorded so far (a later flush starts path over)
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.chunks = 0
+
+    def entries(self):
+        # rows held in memory, oldest first, as a dict of column arrays
+        i = (self.start + np.arange(self.size)) % self.capacity
+        return {name: column[i] for name, column in self.columns.items()}
+
+    def flush(self):
+        # write the rows held in memory to path and empty the buffer
+        if self.path is None or self.size == 0:
+            return
+        self.save(self.entries(), self.size)
+        self.start = 0
+        self.size = 0
+
+    def save(self, rows, k):
+        if self.path.endswith(".npz"):
+            np.savez(self.path[:-len(".npz")] + "." + str(self.chunks) + ".npz", **rows)
+        else:
+            with open(self.path, "a" if self.flushed else "w") as f:
+                if not self.flushed:
+                    f.write(",".join(self.COLUMNS) + "\n")
+                np.savetxt(f, np.column_stack([rows[name] for name in self.COLUMNS]), fmt="%d", delimiter=",")
+        self.chunks += 1
+        self.flushed += k
+
+    def dump(self):
+        # print the rows held in memory
+        states = self.model.contagion.states
+        sites = self.model.world.sites
+        entries = self.entries()
+        for step, agent, event, src, dst, site in zip(*[entries[name] for name in self.COLUMNS]):
+            where = (" at " + sites[site].activity.label + " site " + str(sites[site].site_id)) if site >= 0 else ""
+            print(str(step) + "\tagent " + str(agent) + "\t" + self.EVENTS[event] + " " + states[src].id + " --> " + states[dst].id + where)
+
+
+class Streams():
+    # The model's random numbers, all from one seed
+    # Each use has a stream of its own, so drawing more or less from one
+    # (another infection, a bigger population) leaves the others alone
+    #   schedule       site assignment in Schedule.sched
+    #   infect         agents picked by SchedModel.infect
+    #   transmission   contagion draws while stepping
+    # draws hands transmission numbers to SchedAgent.advance from pre-generated
+    # blocks; key seeds the ArrayEngine's per-chunk streams
+
+    NAMES = ("schedule", "infect", "transmission")
+
+    def __init__(self, seed=None):
+        self.seed(seed)
+
+    def seed(self, seed=None, names=NAMES):
+        # new streams from seed (fresh entropy if None); names picks which ones
+        for name, child in zip(self.NAMES, np.random.SeedSequence(seed).spawn(len(self.NAMES))):
+            if name not in names:
+                continue
+            setattr(self, name, np.random.default_rng(child))
+            if name == "transmission":
+                self.key = int(child.generate_state(1, np.uint64)[0])
+                self.draws = Draws(self.transmission)
+
+    def getstate(self):
+        # everything needed to carry on drawing, as plain data
+        state = {name: getattr(self, name).bit_generator.state for name in self.NAMES}
+        state["key"] = self.key
+        state["draws"] = self.draws.getstate()
+        return state
+
+    def setstate(self, state):
+        for name in self.NAMES:
+            getattr(self, name).bit_generator.state = state[name]
+        self.key = state["key"]
+        self.draws.setstate(state["draws"])
+
+
+class Draws():
+    # Uniform numbers in [0, 1) from a Generator, made a block at a time
+    # next() hands them out one by one; it is a C-level iterator step, as cheap
+    # per call as random.random(), with the generating done BLOCK numbers at a time
+
+    BLOCK = 4096
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.start = None       # generator state the current block was made from
+        self.size = 0
+        self.it = iter([])      # what is left of the current block
+        self.next = itertools.chain.from_iterable(self.blocks()).__next__
+
+    def blocks(self):
+        yield self.it
+        while True:
+            self.start = self.rng.bit_generator.state
+            self.size = self.BLOCK
+            self.it = iter(self.rng.random(self.BLOCK).tolist())
+            yield self.it
+
+    def getstate(self):
+        return [self.start, self.size, self.size - self.it.__length_hint__()]
+
+    def setstate(self, state):
+        # remake the current block from the state it was drawn from, used up as far as it had been
+        self.start, self.size, used = state
+        self.it = iter([])
+        if self.start is not None:
+            rng = np.random.Generator(type(self.rng.bit_generator)())
+            rng.bit_generator.state = self.start
+            self.it = iter(rng.random(self.size).tolist())
+            next(itertools.islice(self.it, used, used), None)
+        self.next = itertools.chain.from_iterable(self.blocks()).__next__
+
+    def __getstate__(self):
+        # pickled as the generator and how far through its block it is
+        return {"rng": self.rng, "state": self.getstate()}
+
+    def __setstate__(self, state):
+        self.rng = state["rng"]
+        self.setstate(state["state"])
+
+
+class Timers():
+    # Evolution deadlines, bucketed by the step at which they fall due
+    # An entry is a pair of arrays (positions, entered); `entered` lets stale
+    # entries (the agent has since moved on) be told apart when the bucket comes up
+
+    def __init__(self):
+        self.buckets = {}
+        self.heap = []
+
+    def add(self, step, entry):
+        if step not in self.buckets:
+            self.buckets[step] = []
+            heapq.heappush(self.heap, step)
+        self.buckets[step].append(entry)
+
+    def pop(self, step):
+        # entries due at step (or overdue)
+        entries = []
+        while self.heap and self.heap[0] <= step:
+            entries += self.buckets.pop(heapq.heappop(self.heap))
+        return entries
+
+    def next(self):
+        # earliest step with something due, or None
+        return self.heap[0] if self.heap else None
+
+
+class Profiler():
+    # Optional instrumentation of SchedModel.step
+    # Set model.profiler = Profiler() to turn it on; with the default None
+    # step() laps through no_lap, and the only other cost is one attribute
+    # test per susceptible agent
+    #
+    # seconds[phase]: wall time spent in each phase of a step
+    #   summary    contagion_summary
+    #   commit     committing last step's transitions
+    #   sites      pointing sites at this slot's occupants
+    #   scheduler  the Mesa scheduler's step: every agent's step and advance, and Mesa's own overhead
+    #   advance    ArrayEngine transmission (in place of scheduler)
+    #   evolve     evolution deadlines
+    #   rollover   moving the clock and calendar on
+    # counters:
+    #   neighbor_checks        co-occupants looked at by agents able to catch something
+    #   transmission_attempts  of those, neighbors in a state they react to
+    #   transitions            state changes committed
+    #   steps, skipped_steps   steps run, and quiet steps jumped over by forward()
+    # peaks[site index]: largest occupancy seen at each site
+    # If every is set, callback(profiler, model) is called every `every` steps
+
+    PHASES = ("summary", "commit", "sites", "scheduler", "advance", "evolve", "rollover")
+    COUNTERS = ("neighbor_checks", "transmission_attempts", "transitions", "steps", "skipped_steps")
+
+    def __init__(self, every=0, callback=None):
+        self.every = every
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.peaks = np.zeros(0, dtype=np.int64)
+
+    def lap(self, phase, start):
+        # charge the time since start to phase; returns the time now
+        now = time.perf_counter()
+        self.seconds[phase] += now - start
+        return now
+
+    def contacts(self, neighbors, triggers):
+        # neighbors: state indices of an agent's co-occupants
+        self.counters["neighbor_checks"] += len(neighbors)
+        self.counters["transmission_attempts"] += sum([1 for u in neighbors if u in triggers])
+
+    def occupancy(self, occupied):
+        # record this slot's per-site occupancy
+        if len(self.peaks) < len(occupied):
+            self.peaks = np.concatenate([self.peaks, np.zeros(len(occupied) - len(self.peaks), dtype=np.int64)])
+        np.maximum(self.peaks[:len(occupied)], occupied, out=self.peaks[:len(occupied)])
+
+    def stepped(self, model):
+        self.counters["steps"] += 1
+        if self.every and self.callback is not None and self.counters["steps"] % self.every == 0:
+            self.callback(self, model)
+
+    def totals(self):
+        # everything collected so far, plus per-step averages
+        steps = max(self.counters["steps"], 1)
+        return {
+            "seconds": dict(self.seconds),
+            "seconds_per_step": {phase: t / steps for phase, t in self.seconds.items()},
+            "counters": dict(self.counters),
+            "peak_occupancy": int(self.peaks.max()) if len(self.peaks) else 0,
+        }
+
+    def hottest(self, model, n=5):
+        # the n sites with the largest peak occupancy, as (label, site_id, peak)
+        sites = model.world.sites
+        order = np.argsort(-self.peaks, kind="stable")[:n]
+        return [(sites[i].activity.label, sites[i].site_id, int(self.peaks[i])) for i in order]
+
+    def summary(self, model):
+        # one-paragraph text report
+        totals = self.totals()
+        lines = ["Profile after " + str(self.counters["steps"]) + " steps (" + str(self.counters["skipped_steps"]) + " skipped)"]
+        total = sum(self.seconds.values()) or 1
+        for phase, t in self.seconds.items():
+            lines += ["\t" + phase + "\t%.4fs\t%5.1f%%" % (t, 100 * t / total)]
+        for name in ("neighbor_checks", "transmission_attempts", "transitions"):
+            lines += ["\t" + name + "\t" + str(self.counters[name])]
+        lines += ["\tbusiest sites\t" + ", ".join([label + " " + str(i) + ": " + str(peak) for (label, i, peak) in self.hottest(model)])]
+        return "\n".join(lines)
+
+
+def no_lap(phase, start):
+    # Profiler.lap when there is no profiler
+    return start
+
+
+def index_dtype(n):
+    # smallest unsigned integer type that can hold the indices 0..n-1
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+class Population():
+    # Every agent's data, held column-wise in numpy arrays indexed by unique_id
+    # (unique_ids run 0..size-1, one contiguous block per class)
+    #   kind[i]         index of the agent's class in `classes`
+    #   state[i]        index of its current state, next_state[i] of the one it moves to next
+    #   entered[i]      step at which it entered its current state
+    # and, once Schedule.sched has run,
+    #   template[k, slot]  index of the activity class k does in each slot (day * hours + hour)
+    #   fave[act, i]       index of agent i's preferred site for an activity
+    #                      (unused for activities its class never does)
+    # so agent i is at site fave[template[kind[i], slot], i]. Each column uses the
+    # smallest integer type that fits: an agent costs a few bytes plus one to
+    # four per activity, however long the week
+    # Both engines read and write these arrays; SchedAgent objects are views onto one row
+
+    def __init__(self, classes, n_states):
+        # classes: list of (name, default Activity, number)
+        self.classes = [name for (name, default, number) in classes]
+        self.defaults = [default for (name, default, number) in classes]
+        self.size = sum([number for (name, default, number) in classes])
+        self.bounds = np.cumsum([0] + [number for (name, default, number) in classes]).tolist()
+        self.kind = np.repeat(np.arange(len(classes)), [number for (name, default, number) in classes]).astype(index_dtype(len(classes)))
+        self.state = np.zeros(self.size, dtype=index_dtype(n_states))
+        self.next_state = np.zeros(self.size, dtype=index_dtype(n_states))
+        self.entered = np.zeros(self.size, dtype=np.int32)
+        self.template = None
+        self.fave = None
+        self.last = None
+
+    def assign(self, template, fave):
+        # take on a site assignment
+        self.template = template
+        self.fave = fave
+        self.last = None
+
+    def sites(self, slot):
+        # site index of every agent during a slot: one contiguous copy per class
+        # The last slot asked for is kept, since a step asks for the same one
+        # several times; the row is shared, so don't write to it
+        if self.last is None or self.last[0] != slot:
+            row = np.empty(self.size, dtype=self.fave.dtype)
+            for k in range(len(self.classes)):
+                start, stop = self.bounds[k], self.bounds[k + 1]
+                row[start:stop] = self.fave[self.template[k, slot], start:stop]
+            self.last = (slot, row)
+        return self.last[1]
+
+    def week(self, i):
+        # site index of agent i in every slot of the week
+        return self.fave[self.template[self.kind[i]], i]
+
+    def reset(self):
+        # everyone back to the first state
+        self.state[:] = 0
+        self.next_state[:] = 0
+        self.entered[:] = 0
+
+    def nbytes(self):
+        # memory held by the population arrays
+        arrays = [self.kind, self.state, self.next_state, self.entered]
+        if self.fave is not None:
+            arrays += [self.template, self.fave]
+        return sum([a.nbytes for a in arrays])
+
+
+class Agents(Mapping):
+    # model.agents: unique_id -> SchedAgent
+    # Views are made the first time an agent is asked for and kept, so the
+    # numpy engine never has to make one per agent
 
     def __init__(self, model):
-        self.entries = []
         self.model = model
+        self.size = model.population.size
+        self.views = {}
 
-    def add(self, text):
-        self.entries += [(self.model.steps, text)]
+    def __getitem__(self, unique_id):
+        if unique_id not in self.views:
+            if not 0 <= unique_id < self.size:
+                raise KeyError(unique_id)
+            self.views[unique_id] = SchedAgent(unique_id, self.model)
+        return self.views[unique_id]
 
-    def dump(self):
-        for entry in entries:
-            print(entry)
+    def __iter__(self):
+        return iter(range(self.size))
 
+    def __len__(self):
+        return self.size
 
-class SchedAgent(Agent):
-    # Main agent class
 
-    def __init__(self, unique_id, model, kind, calendar, default):
-        # default is the agent's default activity
-        super().__init__(unique_id, model)
-        self.site = -1
-        self.kind = kind
-        self.hours = calendar.hours
-        self.days = calendar.days
-        self.default = default
-        self.calendar = [[default for hour in range(calendar.hours)] for day in range(calendar.days)]
-        self.activities = set([])
-        self.model = model
-        self.neighbors = []
-        self.log = Log(model)
-
-        self.state = model.contagion.states[0]
-        self.next_state = self.state
-        self.last_change = 0
+class SchedAgent():
+    # Main agent class
+    # A view onto row unique_id of model.population; the Mesa scheduler only
+    # needs unique_id, step() and advance(). site is the agent's Site for the
+    # current step, set in step() and read in advance()
 
-    def constrain(self, constraint):
-        # This method places a constraint (obj; see below) on the agent's schedule
+    __slots__ = ("unique_id", "model", "site")
 
-        if not self.calendar[constraint.day][constraint.hour] == self.default:
-            raise ValueError("Conflicting constraints on agent " + str(self.unique_id) + " (" + self.kind + ")")
-        act = self.model.activities[constraint.activity]
-        self.calendar[constraint.day][constraint.hour] = act
-        self.activities |= set([act])
+    def __init__(self, unique_id, model):
+        self.unique_id = unique_id
+        self.model = model
+        self.site = None
+
+    @property
+    def kind(self):
+        population = self.model.population
+        return population.classes[population.kind[self.unique_id]]
+
+    @property
+    def default(self):
+        # the agent's default activity
+        population = self.model.population
+        return population.defaults[population.kind[self.unique_id]]
+
+    @property
+    def state(self):
+        return self.model.contagion.states[self.model.population.state[self.unique_id]]
+
+    @state.setter
+    def state(self, state):
+        # move the agent to state now, with the bookkeeping commit() does:
+        # counts, entered and an evolution deadline (a transition already
+        # waiting to be committed still goes ahead)
+        model = self.model
+        population = model.population
+        i = self.unique_id
+        old = population.state[i]
+        if old == state.index:
+            return
+        model.counts[old] -= 1
+        model.counts[state.index] += 1
+        if population.next_state[i] == old:
+            population.next_state[i] = state.index
+        population.state[i] = state.index
+        population.entered[i] = model.steps
+        model.add_timers(np.array([i]))
+
+    @property
+    def next_state(self):
+        return self.model.contagion.states[self.model.population.next_state[self.unique_id]]
+
+    @next_state.setter
+    def next_state(self, state):
+        self.model.population.next_state[self.unique_id] = state.index
+
+    @property
+    def entered(self):
+        return int(self.model.population.entered[self.unique_id])
+
+    @entered.setter
+    def entered(self, step):
+        self.model.population.entered[self.unique_id] = step
+
+    @property
+    def last_change(self):
+        # steps spent in the current state
+        return self.model.steps - self.entered
+
+    @property
+    def calendar(self):
+        # calendar[day][hour]: the Site visited (the default Activity before sched())
+        model = self.model
+        if model.population.fave is None:
+            return [[self.default for hour in range(model.hours)] for day in range(model.days)]
+        cells = [model.world.sites[j] for j in model.population.week(self.unique_id).tolist()]
+        return [cells[day * model.hours:(day + 1) * model.hours] for day in range(model.days)]
+
+    @property
+    def activities(self):
+        # the activities the agent's week takes it to
+        return set([cell.activity if isinstance(cell, Site) else cell for day in self.calendar for cell in day])
 
     def show_activity(self):
         # display... 
 
+        calendar = self.calendar
         print("\nAgent " + str(self.unique_id) + " of kind " + self.kind)
         print("Activities (days across, hours down)")
-        print("\t".join(["\t" + str(i) for i in range(self.days)]))
-        for hour in range(self.hours):
-            print(str(hour) + ": " + "\t".join([str(self.calendar[day][hour].label) for day in range(self.days)]))
+        print("\t".join(["\t" + str(i) for i in range(self.model.days)]))
+        for hour in range(self.model.hours):
+            print(str(hour) + ": " + "\t".join([str(getattr(calendar[day][hour], "activity", calendar[day][hour]).label) for day in range(self.model.days)]))
 
     def show_site(self):
         # display... 
 
+        calendar = self.calendar
         print("\nAgent " + str(self.unique_id) + " of kind " + self.kind)
         print("Sites (days across, hours down)")
-        print("\t".join(["\t" + str(i) for i in range(self.days)]))
-        for hour in range(self.hours):
-            print(str(hour) + ": " + "\t".join([str(self.calendar[day][hour]) for day in range(self.days)]))
+        print("\t".join(["\t" + str(i) for i in range(self.model.days)]))
+        for hour in range(self.model.hours):
+            print(str(hour) + ": " + "\t".join([str(calendar[day][hour]) for day in range(self.model.days)]))
 
     def step(self):
         # go to current scheduled location
+        # (last step's transitions have already been committed by SchedModel.commit)
 
-        self.state = self.next_state
-        self.next_state = self.state
-        self.log.add("state: " + self.state.id)
-        self.site = self.calendar[self.model.day][self.model.hour]
-        self.site.current += [self]
+        model = self.model
+        self.site = model.world.sites[model.population.sites(model.day * model.hours + model.hour).item(self.unique_id)]
 
     def advance(self):
         # progresses the contagion model (rename this function)
 
-        neighbor_states = [agent.state.id for agent in self.site.current if agent is not self]
-        if (self.state.evolution is not None):
-            self.last_change += 1
-            if self.last_change == self.state.evolution[1]:
-                self.next_state = [state for state in self.model.contagion.states if state.id == self.state.evolution[0]][0]
-        elif len(self.state.transitions) > 0:
-            infected = False
-            triggers = [u for (u,v,w) in self.state.transitions]
-            for neighbor in self.site.current:
-                if neighbor.state.id in triggers and random.random() < self.site.transmission:
-                    T = [(t[0],t[1],t[2]) for t in self.state.transitions if t[0] == neighbor.state.id]
-                    T = random.choice(T) # currently only supporting uniform random nondeterminism
-                    if random.random() < T[2]:
-                        self.next_state = [state for state in self.model.contagion.states if state.id == T[1]][0]
-                        self.log.add("infection " + self.state.id + " --> " + self.next_state.id + " at " + self.site.activity.label + " site " + str(self.site.site_id))
-                        self.last_change = 0
+        # evolution is driven by SchedModel.timers; an evolving state ignores its neighbors
+        model = self.model
+        codes = model.population.state
+        state = model.contagion.states[codes.item(self.unique_id)]
+        if (state.evolution is None and len(state.transitions) > 0):
+            triggers = state.triggers
+            neighbors = self.site.states
+            if model.profiler is not None:
+                model.profiler.contacts(neighbors, triggers)
+            draw = model.streams.draws.next
+            for trigger in neighbors:
+                if trigger in triggers and draw() < self.site.transmission:
+                    rules = state.rules[trigger]
+                    T = rules[int(draw() * len(rules))] # currently only supporting uniform random nondeterminism
+                    if draw() < T[1]:
+                        model.population.next_state[self.unique_id] = T[0].index
+                        model.pending += 1
+                        model.journal.add(Log.INFECTION, self.unique_id, state.index, T[0].index, self.site.index)
 
 
 
@@ -143,14 +662,17 @@ class Activity():
 
 class Site():
     # Has activities and agents
-    
+
+    __slots__ = ("activity", "transmission", "site_id", "capacity", "occupied", "current", "states", "index")
+
     def __init__(self, activity, site_id, capacity, occupied):
         self.activity = activity
         self.transmission = activity.transmission
         self.site_id = site_id
         self.capacity = capacity
         self.occupied = occupied
-        self.current = []
+        self.current = []   # agents here this hour
+        self.states = []    # and the indices of their states
 
 
 class Constraint():
@@ -168,113 +690,870 @@ class Constraint():
 class Schedule():
     # not to be confused with the scheduler in Mesa
     # this is actually a schedule table
+    # After sched(), self.occupancy (an Occupancy) holds who is where, in numbers
+    # retemplate, relocate and the rest change a finished schedule in place
+    # (see SchedModel's interventions); a class always holds preferred sites
+    # for exactly the activities in its template
 
-    def __init__(self, AGENTS, CLASSES, ACTIVITIES, CONSTRAINTS, CALENDAR):
+    def __init__(self, POPULATION, ACTIVITIES, CONSTRAINTS, CALENDAR):
         self.activities = ACTIVITIES
-        self.agents = AGENTS
+        self.population = POPULATION
         self.constraints = CONSTRAINTS
         self.days = CALENDAR.days
         self.hours = CALENDAR.hours
-        self.classes = CLASSES
         self.sites = []
-
+        self.closed = set()     # indices of closed activities
 
     def show(self):
         # display...
 
+        population = self.population
         for day in range(self.days):
             for hour in range(self.hours):
                 print("Site assignments at hour " + str(hour) + " of day " + str(day))
                 for site in self.sites:
                     print("\tSite " + str(site.site_id) + " for activity " + site.activity.label)
-                    for agent in self.agents:
-                        if agent.calendar[day][hour] is site:
-                            print("\t\tAgent " + str(agent.unique_id) + " of kind " + agent.kind)
+                    for i in self.membership.members(day * self.hours + hour, site.index):
+                        print("\t\tAgent " + str(i) + " of kind " + population.classes[population.kind[i]])
 
     def show_occupancy(self, kind="all"):
         # display...
+        # rendered from self.occupancy, one print per day
 
-        if kind == "all":
-            select = [agent for (key,agent) in self.agents.items()]
-        else:
-            select = [agent for (key, agent) in self.agents.items() if agent.kind == kind]
+        counts = self.occupancy.array(kind)
+        rule = "".join(["--------" for hour in range(self.hours + 3)])
+        numbers = [str(n) for n in range(int(counts.max(initial=0)) + 1)]
+        prefix = [site.activity.label + "\t" + str(site.site_id) + "\t|\t" for site in self.sites]
         for day in range(self.days):
-            print("\n\n" + "".join(["----" for hour in range(self.hours)]) + "\tDAY\t" + str(day) + "\t" + "".join(["----" for hour in range(self.hours+1)]))
-            print("\tSite occupancy by " + kind + " agents")
-            print("\n\t\t\t" + "\t".join(["" for hour in range(self.hours // 2)]) + "Hour")
-            print("\nAct.\tSite\t|\t" + "\t".join([str(hour) for hour in range(self.hours)]))
-            print("".join(["--------" for hour in range(self.hours + 3)]))
+            occupied = counts[day * self.hours:(day + 1) * self.hours].T.tolist()
+            lines = ["\n\n" + "".join(["----" for hour in range(self.hours)]) + "\tDAY\t" + str(day) + "\t" + "".join(["----" for hour in range(self.hours+1)])]
+            lines += ["\tSite occupancy by " + kind + " agents"]
+            lines += ["\n\t\t\t" + "\t".join(["" for hour in range(self.hours // 2)]) + "Hour"]
+            lines += ["\nAct.\tSite\t|\t" + "\t".join([str(hour) for hour in range(self.hours)])]
+            lines += [rule]
             for key, act in self.activities.items():
-                for site in self.sites:
-                    if site.activity is act:
-                        print(key + "\t" + str(site.site_id) + "\t|\t" + "\t".join([str(sum([1 for agent in select if agent.calendar[day][hour] is site])) for hour in range(self.hours)]))
-                print("".join(["--------" for hour in range(self.hours + 3)]))
+                for i in self.occupancy.sites_of.get(act.index, []):
+                    lines += [prefix[i] + "\t".join([numbers[n] for n in occupied[i]])]
+                lines += [rule]
+            print("\n".join(lines))
 
 
-    def sched(self, world):
-        # schedule everything 
+    def sched(self, world, rng):
+        # schedule everything, drawing from the Generator rng
 
         self.sites = []
+        population = self.population
+        n = population.size
+        slots = self.days * self.hours
 
         #print("\n\nACTIVITY ASSIGNMENT\n\n")
 
+        acts = list(self.activities.values())
+        for i, act in enumerate(acts): act.index = i
+
+        # template[k, slot]: index of the activity class k does in that slot,
+        # starting from the class's default; every member of a class shares it
+        classes = population.classes
+        template = np.array([[act.index] * slots for act in population.defaults], dtype=index_dtype(len(acts))).reshape(len(classes), slots)
         for constraint in self.constraints:
-            for agent in self.classes[constraint.agent]:
-                # build class dict to speed this up
-                agent.constrain(constraint)
+            if constraint.agent not in classes:
+                raise ValueError("Constraint on unknown class " + str(constraint.agent) + " at day " + str(constraint.day) + ", hour " + str(constraint.hour))
+            k = classes.index(constraint.agent)
+            slot = constraint.day * self.hours + constraint.hour
+            if template[k, slot] != population.defaults[k].index:
+                raise ValueError("Conflicting constraints on class " + constraint.agent + " at day " + str(constraint.day) + ", hour " + str(constraint.hour))
+            template[k, slot] = self.activities[constraint.activity].index
 
         #print("\n\nSITE ASSIGNMENT\n\n")
 
-        for key, act in self.activities.items():
+        # occupancy[act, slot]: number of agents doing it
+        # uses[k, act]: whether class k ever does it
+        sizes = np.diff(population.bounds)
+        occupancy = np.zeros((len(acts), slots), dtype=np.int64)
+        uses = np.zeros((len(classes), len(acts)), dtype=bool)
+        for k in range(len(classes)):
+            occupancy[template[k], np.arange(slots)] += sizes[k]
+            uses[k, template[k]] = True
+
+        rooms = []
+        for act in acts:
             # Make room for the busiest times
-            times = [(hour, day) for hour in range(self.hours) for day in range(self.days)]
-            most = max([sum([(1 if agent.calendar[day][hour] is act else 0) for (key, agent) in self.agents.items()]) for (hour, day) in times])
-            for i in range(ceil(most/act.capacity)): self.sites += [Site(act, i, act.capacity, 0)]
+            rooms += [[Site(act, i, act.capacity, 0) for i in range(ceil(occupancy[act.index].max()/act.capacity))]]
+            self.sites += rooms[-1]
+        for i, site in enumerate(self.sites): site.index = i
 
-        for key, act in self.activities.items():
+        # fave[act, agent]: index of the agent's preferred site for that activity
+        fave = np.zeros((len(acts), n), dtype=np.int32)
+        for act, room in zip(acts, rooms):
             # For each activity, each agent is assigned one preferred site
-            candidates = set([site for site in self.sites if site.activity is act])
-            for (key, agent) in self.agents.items():
-                fave = None
-                if(act in agent.activities and len(candidates) > 0):                    # If I do this activity
-                    site = random.choice(list(candidates))                              # Pick a site
-                    while fave is None and site.occupied >= site.capacity:              # While no space
-                        if(site.occupied == site.capacity): candidates -= set([site])   # Remove candidate
-                        site = random.choice(list(candidates))                          # Keep looking
-                    fave = site                     # It's my space now
-                    site.occupied += 1              # Less space for you
-
-                    for day in range(self.days):                                        # Favored site chosen
-                        for hour in range(self.hours):                                  # for *all* instances
-                            if agent.calendar[day][hour] is act:                        # of this activity
-                                agent.calendar[day][hour] = fave
+            k = len(room)
+            for c in np.flatnonzero(uses[:, act.index]):
+                start, stop = population.bounds[c], population.bounds[c + 1]
+                fave[act.index, start:stop], k = self.fill(act, room, k, stop - start, rng)
+
+        # Favored site chosen for *all* instances of each activity
+        self.adopt(world, self.sites, template, fave.astype(index_dtype(len(self.sites))))
+
+    def fill(self, act, room, k, n, rng):
+        # preferred sites of act for n agents, each drawn uniformly from the
+        # sites with room left, with a new site opened whenever there is none
+        # room is all of the activity's sites, the k with room left at the front;
+        # one that fills up is moved past them, so every draw is O(1)
+        # Agents draw a block at a time: each site keeps as many of its draws
+        # as it has room for, in agent order, and the rest draw again from the
+        # sites still with room. When a block places less than half its agents
+        # (the last few places), the rest draw one by one
+        # returns the site indices and the new k
+        picks = np.zeros(n, dtype=np.int64)
+        todo = np.arange(n)
+        if k > 0:
+            k0 = k
+            order = np.arange(k)
+            index = np.array([site.index for site in room[:k]], dtype=np.int64)
+            left = np.array([site.capacity - site.occupied for site in room[:k]], dtype=np.int64)
+            while k > 0 and len(todo) > 0:
+                j = (rng.random(len(todo)) * k).astype(np.int64)
+                # a site drawn more often than it has room for keeps its first draws:
+                # rank those by order of drawing among the draws of the same site
+                counts = np.bincount(j, minlength=k)
+                keep = (counts <= left[order[:k]])[j]
+                over = np.flatnonzero(~keep)
+                if len(over):
+                    jo = j[over]
+                    ranked = over[np.argsort(jo, kind="stable")]
+                    n_over = np.bincount(jo, minlength=k)
+                    rank = np.arange(len(over)) - np.repeat(np.cumsum(n_over) - n_over, n_over)
+                    keep[ranked] = rank < left[order[j[ranked]]]
+                picks[todo[keep]] = index[order[j[keep]]]
+                todo = todo[~keep]
+                left[order[:k]] -= np.minimum(counts, left[order[:k]])
+                order[:k] = np.concatenate([order[:k][left[order[:k]] > 0], order[:k][left[order[:k]] == 0]])
+                k = int((left > 0).sum())
+                if 2 * keep.sum() < len(keep):
+                    break
+            sites = room[:k0]
+            room[:k0] = [sites[i] for i in order.tolist()]
+            for site, free in zip(sites, left.tolist()):
+                site.occupied = site.capacity - free
+
+        done = 0
+        agents, draws = (todo.tolist(), rng.random(len(todo)).tolist()) if k > 0 else ([], [])
+        while done < len(agents) and k > 0:
+            j = int(draws[done] * k)
+            site = room[j]
+            site.occupied += 1
+            picks[agents[done]] = site.index
+            if site.occupied >= site.capacity:
+                k -= 1
+                room[j], room[k] = room[k], room[j]
+            done += 1
+        todo = todo[done:]
+
+        if len(todo):
+            # more agents do this activity overall than at its busiest time:
+            # open sites for the rest and fill them one after another
+            capacity = act.capacity
+            occupied = np.minimum(capacity, len(todo) - capacity * np.arange(ceil(len(todo) / capacity))).tolist()
+            opened = [Site(act, len(room) + i, capacity, held) for i, held in enumerate(occupied)]
+            for i, site in enumerate(opened):
+                site.index = len(self.sites) + i
+            picks[todo] = len(self.sites) + np.arange(len(todo)) // capacity
+            self.sites += opened
+            spare = [site for site in opened if site.occupied < capacity]
+            room[:] = spare + room + opened[:len(opened) - len(spare)]
+            k = len(spare)
+        return picks, k
+
+    def adopt(self, world, sites, template, fave):
+        # take on a finished site assignment (see Population)
+        # (from sched(), or from a checkpoint, without scheduling again)
+        self.sites = sites
+        for i, act in enumerate(self.activities.values()): act.index = i
+        for i, site in enumerate(self.sites): site.index = i
+        self.population.assign(template, fave)
+
+        # The week repeats, so who is where can be worked out once per slot
+        self.membership = Membership(self.population, len(self.sites), world.agents)
+        self.occupancy = Occupancy(self.population, self.sites, self.days, self.hours)
 
         world.sites = self.sites # pass the sites off to this dumb object I should rethink
+        world.membership = self.membership
+
+    def retemplate(self, k, slots, act, rng):
+        # class k does activity act (an index) during slots instead;
+        # it gets preferred sites if the activity is new to it and gives up
+        # those of any activity it no longer does
+        template = self.population.template
+        before = template[k, slots].copy()
+        if not (template[k] == act).any():
+            self.claim(k, act, rng)
+        self.occupancy.shift(k, slots, before, act)
+        template[k, slots] = act
+        for old in np.unique(before).tolist():
+            if old != act and not (template[k] == old).any():
+                self.release(k, old)
+        self.changed(slots)
+
+    def claim(self, k, act, rng):
+        # draw class k's preferred sites for activity act
+        if act in self.closed:
+            raise ValueError("Activity " + self.acts()[act].label + " is closed")
+        start, stop = self.population.bounds[k], self.population.bounds[k + 1]
+        room, free = self.room(act)
+        picks, free = self.fill(self.acts()[act], room, free, stop - start, rng)
+        self.grow()
+        self.population.fave[act, start:stop] = picks
+        self.occupancy.by_class[:, k] += np.bincount(picks, minlength=len(self.sites))
+
+    def release(self, k, act):
+        # class k gives up its preferred sites for activity act
+        start, stop = self.population.bounds[k], self.population.bounds[k + 1]
+        picks = np.bincount(self.population.fave[act, start:stop], minlength=len(self.sites))
+        for i in np.flatnonzero(picks).tolist():
+            self.sites[i].occupied -= int(picks[i])
+        self.occupancy.by_class[:, k] -= picks
+
+    def relocate(self, act, agents, rng):
+        # draw new preferred sites of activity act for agents (unique_ids of
+        # classes that do it), from the sites with room left
+        population = self.population
+        old = population.fave[act, agents].astype(np.int64)
+        for i, n in zip(*np.unique(old, return_counts=True)):
+            self.sites[i].occupied -= int(n)
+        room, free = self.room(act)
+        picks, free = self.fill(self.acts()[act], room, free, len(agents), rng)
+        self.grow()
+        population.fave[act, agents] = picks
+        new = picks
+
+        # only the moved agents' classes, in the slots they do act, change
+        m = len(self.sites)
+        kinds = population.kind[agents]
+        for k in np.unique(kinds).tolist():
+            delta = np.bincount(new[kinds == k], minlength=m) - np.bincount(old[kinds == k], minlength=m)
+            self.occupancy.by_class[:, k] += delta
+            slots = np.flatnonzero(population.template[k] == act)
+            changed = np.flatnonzero(delta)
+            self.occupancy.add(slots, changed, delta[changed])
+            self.changed(slots)
+
+    def holders(self, act):
+        # unique_ids of the agents holding a preferred site for activity act
+        bounds = self.population.bounds
+        users = [k for k in range(len(bounds) - 1) if (self.population.template[k] == act).any()]
+        return np.concatenate([np.arange(bounds[k], bounds[k + 1]) for k in users] + [np.zeros(0, dtype=np.int64)])
+
+    def room(self, act):
+        # the activity's sites as fill() takes them: those with room first, and how many
+        sites = [self.sites[i] for i in self.occupancy.sites_of.get(act, [])]
+        room = [site for site in sites if site.occupied < site.capacity]
+        return room + [site for site in sites if site.occupied >= site.capacity], len(room)
+
+    def acts(self):
+        # activities by index
+        return list(self.activities.values())
+
+    def grow(self):
+        # make room in the per-site tables for sites opened since they were made
+        population = self.population
+        n = len(self.sites)
+        if np.iinfo(population.fave.dtype).max < n - 1:
+            population.fave = population.fave.astype(index_dtype(n))
+        self.occupancy.grow()
+        self.membership.grow(n)
+
+    def changed(self, slots):
+        # forget what was worked out about who is where during slots
+        self.population.last = None
+        self.membership.forget(slots)
+
+
+class Occupancy():
+    # Number of agents at every site in every slot (day * hours + hour) of the week,
+    # worked out once after scheduling
+    #   counts[slot, site]   agents at a site during a slot
+    #   by_class[site, k]    agents of class k whose preferred site it is for its activity
+    # A class's agents are at their preferred site exactly when the class template
+    # says that site's activity, so per-class counts come from by_class and the
+    # template without going back to the agents
+    # Interventions keep both up to date (shift, add, grow) rather than starting over
+
+    def __init__(self, population, sites, days, hours):
+        self.population = population
+        self.sites = sites
+        self.days = days
+        self.hours = hours
+        self.activity_of = np.array([site.activity.index for site in sites], dtype=np.int64)
+        # sites_of: activity index -> indices of its sites; labels: activity label -> activity index
+        order = np.argsort(self.activity_of, kind="stable")
+        acts, starts = np.unique(self.activity_of[order], return_index=True)
+        self.sites_of = dict(zip(acts.tolist(), np.split(order, starts[1:])))
+        self.labels = dict([(sites[i].activity.label, act) for act, i in zip(acts.tolist(), order[starts].tolist())])
+
+        template = population.template
+        self.by_class = np.zeros((len(sites), len(population.classes)), dtype=np.int64)
+        for k in range(len(population.classes)):
+            start, stop = population.bounds[k], population.bounds[k + 1]
+            for act in np.unique(template[k]):
+                self.by_class[:, k] += np.bincount(population.fave[act, start:stop], minlength=len(sites))
+        self.counts = self.array()
+
+    def shift(self, k, slots, before, act):
+        # class k moves from activity before[i] to act during slots[i]
+        for old in np.unique(before).tolist():
+            if old in self.sites_of:
+                sites = self.sites_of[old]
+                self.add(slots[before == old], sites, -self.by_class[sites, k])
+        if act in self.sites_of:
+            sites = self.sites_of[act]
+            self.add(slots, sites, self.by_class[sites, k])
+
+    def add(self, slots, sites, delta):
+        # counts[slots, sites] += delta (one value per site), widening the type of counts if they outgrow it
+        cells = np.ix_(slots, sites)
+        new = self.counts[cells].astype(np.int64) + delta
+        if new.size and new.max() > np.iinfo(self.counts.dtype).max:
+            self.counts = self.counts.astype(index_dtype(int(new.max()) + 1))
+        self.counts[cells] = new
+
+    def grow(self):
+        # take in sites added to the end of the site list
+        sites = self.sites[len(self.activity_of):]
+        if len(sites) == 0:
+            return
+        for site in sites:
+            act = site.activity.index
+            self.sites_of[act] = np.append(self.sites_of.get(act, np.zeros(0, dtype=np.int64)), site.index)
+            self.labels[site.activity.label] = act
+        self.activity_of = np.append(self.activity_of, [site.activity.index for site in sites])
+        self.by_class = np.concatenate([self.by_class, np.zeros((len(sites), self.by_class.shape[1]), dtype=self.by_class.dtype)])
+        self.counts = np.concatenate([self.counts, np.zeros((len(self.counts), len(sites)), dtype=self.counts.dtype)], axis=1)
+
+    def kinds(self, kind):
+        # class indices selected by kind ("all" or a class name)
+        classes = self.population.classes
+        return range(len(classes)) if kind == "all" else [classes.index(kind)]
+
+    def array(self, kind="all", by_class=False):
+        # (slots x sites) counts for everyone or one class,
+        # or (slots x sites x classes) with by_class
+        # filled one (class, activity) block at a time: the slots the class spends
+        # on the activity, by the activity's sites
+        template = self.population.template
+        dtype = index_dtype(int(self.by_class.sum(axis=1).max(initial=0)) + 1)
+        shape = (template.shape[1], len(self.sites)) + ((len(self.population.classes),) if by_class else ())
+        out = np.zeros(shape, dtype=dtype)
+        for k in self.kinds(kind):
+            for act in np.unique(template[k]):
+                if act not in self.sites_of:
+                    continue
+                slots, sites = np.flatnonzero(template[k] == act), self.sites_of[act]
+                if by_class:
+                    out[slots[:, None], sites[None, :], k] = self.by_class[sites, k].astype(dtype)
+                else:
+                    out[np.ix_(slots, sites)] += self.by_class[sites, k].astype(dtype)
+        return out
+
+    def at(self, day, hour, kind="all"):
+        # per-site counts at one hour
+        if kind == "all":
+            return self.counts[day * self.hours + hour]
+        return self.array(kind)[day * self.hours + hour]
+
+    def site(self, index, kind="all"):
+        # counts at one site (by index) for every slot of the week
+        if kind == "all":
+            return self.counts[:, index]
+        return self.array(kind)[:, index]
+
+    def activity(self, label, kind="all"):
+        # agents doing an activity in every slot of the week
+        if label not in self.labels:
+            raise ValueError("No sites for activity " + label)
+        counts = self.counts if kind == "all" else self.array(kind)
+        return counts[:, self.sites_of[self.labels[label]]].sum(axis=1, dtype=np.int64)
+
+    def peak(self):
+        # largest occupancy of every site over the week
+        return self.counts.max(axis=0) if len(self.counts) else np.zeros(len(self.sites), dtype=self.counts.dtype)
+
+    def busiest(self, n=5):
+        # the n sites with the largest peak occupancy, as (label, site_id, peak)
+        peak = self.peak()
+        order = np.argsort(-peak.astype(np.int64), kind="stable")[:n]
+        return [(self.sites[i].activity.label, self.sites[i].site_id, int(peak[i])) for i in order]
+
+    def rows(self, kind="all", by_class=False, zeros=False):
+        # long-format columns: day, hour, activity, site_id, site, (class,) count
+        counts = self.array(kind, by_class)
+        cells = np.indices(counts.shape).reshape(counts.ndim, -1)
+        values = counts.ravel()
+        if not zeros:
+            cells, values = cells[:, values > 0], values[values > 0]
+        slot, site = cells[0], cells[1]
+        columns = {
+            "day": slot // self.hours,
+            "hour": slot % self.hours,
+            "activity": np.array([s.activity.label for s in self.sites], dtype=object)[site],
+            "site_id": np.array([s.site_id for s in self.sites], dtype=np.int64)[site],
+            "site": site,
+        }
+        if by_class:
+            columns["class"] = np.array(self.population.classes, dtype=object)[cells[2]]
+        columns["count"] = values
+        return columns
+
+    def save(self, path):
+        # everything needed to rebuild the tensor, as a .npz file
+        np.savez(path, counts=self.counts, by_class=self.by_class, template=self.population.template,
+                 activity_of=self.activity_of, site_id=np.array([s.site_id for s in self.sites], dtype=np.int64))
+
+    def to_csv(self, path, kind="all", by_class=False, zeros=False):
+        # write the long-format rows to a CSV file (cells with no one in them are left out unless zeros)
+        columns = self.rows(kind, by_class, zeros)
+        with open(path, "w") as f:
+            f.write(",".join(columns) + "\n")
+            for row in zip(*[values.tolist() for values in columns.values()]):
+                f.write(",".join([str(value) for value in row]) + "\n")
+
+    def to_dataframe(self, kind="all", by_class=False, zeros=False):
+        # the long-format rows as a pandas DataFrame (pandas is only needed here)
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("Occupancy.to_dataframe needs pandas; use rows() or to_csv() without it")
+        return pandas.DataFrame(self.rows(kind, by_class, zeros))
+
+
+class Membership():
+    # Index of site occupants for every slot (day * hours + hour) of the week
+    # CSR layout, worked out for a slot the first time it is needed: the agents
+    # at site j during slot k are order[k][indptr[k][j]:indptr[k][j + 1]], in unique_id order
+    # (only the Mesa engine and show() use it, so the numpy engine never pays for it)
+
+    def __init__(self, population, n_sites, agents):
+        self.population = population
+        self.n_sites = n_sites
+        self.agents = agents
+        self.order = {}
+        self.indptr = {}
+        self.cache = {}
+
+    def index(self, slot):
+        # (order, indptr) of a slot
+        if slot not in self.order:
+            where = self.population.sites(slot)
+            self.order[slot] = np.argsort(where, kind="stable").astype(index_dtype(len(where)))
+            self.indptr[slot] = np.zeros(self.n_sites + 1, dtype=np.int64)
+            self.indptr[slot][1:] = np.cumsum(np.bincount(where, minlength=self.n_sites))
+        return self.order[slot], self.indptr[slot]
+
+    def forget(self, slots):
+        # drop what was worked out for slots, after the schedule changes
+        for slot in np.asarray(slots).tolist():
+            self.order.pop(slot, None)
+            self.indptr.pop(slot, None)
+            self.cache.pop(slot, None)
+
+    def grow(self, n_sites):
+        # sites were opened: every slot has to be worked out again
+        if n_sites != self.n_sites:
+            self.n_sites = n_sites
+            self.order, self.indptr, self.cache = {}, {}, {}
+
+    def members(self, slot, site):
+        # unique_ids of the agents at a site during a slot
+        order, indptr = self.index(slot)
+        return order[indptr[site]:indptr[site + 1]]
+
+    def occupants(self, slot):
+        # per-site lists of agent objects for a slot, built on first use
+        if slot not in self.cache:
+            self.cache[slot] = [[self.agents[i] for i in self.members(slot, site).tolist()] for site in range(self.n_sites)]
+        return self.cache[slot]
 
 
 class World():
     # Contains all the sites
-    # Synchronizes their cleanup
+    # Synchronizes who is at each of them
     # Maybe ought to do some logging later
     # Maybe ought to be removed
 
     def __init__(self):
+        self.agents = None
         self.sites = []
-        self.journal = []
+        self.membership = None
+
+    def load_sites(self, slot, state):
+        # point every site at its precomputed occupant list for this slot,
+        # and at the states (from the population's state array) they are in
+        order, indptr = self.membership.index(slot)
+        states = state[order].tolist()
+        indptr = indptr.tolist()
+        for site, current in zip(self.sites, self.membership.occupants(slot)):
+            site.current = current
+            site.states = states[indptr[site.index]:indptr[site.index + 1]]
+
+
+class ArrayEngine():
+    # Vectorized alternative to stepping every SchedAgent through Mesa
+    # Works directly on the model.population arrays; each hour costs one
+    # bincount per transmitting state plus batched draws instead of a scan
+    # over every co-occupant of every site
+    #
+    # Draws are split into fixed chunks of CHUNK agents, each drawing from its
+    # own stream seeded by (streams.key, step, chunk). With workers > 1 the
+    # chunks are shared out between this process and workers - 1 forked ones.
+    # Sites only interact through their per-site trigger counts, which are
+    # computed here and handed over in shared memory along with the state and
+    # site rows; workers send back their transitions, which are applied in
+    # chunk order before the commit. A run is the same for any worker count,
+    # 0 included
+
+    CHUNK = 65536
+
+    def __init__(self, model, workers=0):
+        self.model = model
+        self.workers = workers
+        self.procs = []
+        self.buffers = None
+        self.transmission = np.array([site.transmission for site in model.world.sites], dtype=float)
+        self.compile()
+
+    def compile(self):
+        # contagion tables, rebuilt whenever the compartment model changes
+        states = self.model.contagion.states
+        self.stop()
+
+        # exposure: for each susceptible state, the (trigger, targets, probabilities) it reacts to
+        # a state with an evolution rule never reacts to neighbors (same as SchedAgent.advance)
+        self.exposures = []
+        for state in states:
+            if state.evolution is not None or len(state.transitions) == 0:
+                continue
+            rules = []
+            for trigger, T in state.rules.items():
+                rules += [(trigger, np.array([v.index for (v, w) in T], dtype=np.int32), np.array([w for (v, w) in T], dtype=float))]
+            self.exposures += [(state.index, rules)]
+        self.triggers = sorted(set([u for (s, rules) in self.exposures for (u, targets, probs) in rules]))
+
+    def transmit(self, profiler=None):
+        # Each co-occupant in a trigger state transmits with probability
+        # site.transmission * mean(p); an agent escapes only if every one fails
+        model = self.model
+        journal = model.journal
+        population = model.population
+        state = population.state
+        site = population.sites(model.day * model.hours + model.hour)
+        m = len(self.transmission)
+        if profiler is not None:
+            occupancy = np.bincount(site, minlength=m)
+            for (s, rules) in self.exposures:
+                profiler.counters["neighbor_checks"] += int(occupancy[site[state == s]].sum())
+        if not model.counts[self.triggers].any():
+            return
+        present = {u: np.bincount(site[state == u], minlength=m) for u in self.triggers}
+        if profiler is not None:
+            for (s, rules) in self.exposures:
+                at = site[state == s]
+                profiler.counters["transmission_attempts"] += int(sum([present[u][at].sum() for (u, targets, probs) in rules]))
+        if self.workers > 1:
+            changes = self.transmit_parallel(state, site, present)
+        else:
+            changes = self.transmit_chunks(state, site, present, model.streams.key, model.steps, range(ceil(len(state) / self.CHUNK)))
+        for (idx, dst, at) in changes:
+            population.next_state[idx] = dst
+            model.pending += len(idx)
+            journal.add_many(Log.INFECTION, idx, state[idx], dst, at)
+
+    def transmit_block(self, state, site, present, start, stop, rng):
+        # draw the transitions of agents start..stop-1 from rng
+        # returns a list of (agents, new states, sites)
+        changes = []
+        for (s, rules) in self.exposures:
+            idx = np.flatnonzero(state[start:stop] == s) + start
+            if len(idx) == 0:
+                continue
+            at = site[idx]
+            transmission = self.transmission[at]
+            escape = np.ones(len(idx))
+            for (u, targets, probs) in rules:
+                escape *= (1 - transmission * probs.mean()) ** present[u][at]
+            hit = rng.random(len(idx)) >= escape
+            if not hit.any():
+                continue
+            idx, at = idx[hit], at[hit]
+
+            # pick the outcome in proportion to its share of the exposure
+            weights = np.concatenate([present[u][at][:, None] * (probs / len(probs)) for (u, targets, probs) in rules], axis=1)
+            targets = np.concatenate([targets for (u, targets, probs) in rules])
+            cumulative = weights.cumsum(axis=1)
+            draw = rng.random(len(idx)) * cumulative[:, -1]
+            pick = (cumulative < draw[:, None]).sum(axis=1)
+            changes += [(idx, targets[np.minimum(pick, len(targets) - 1)], at)]
+        return changes
+
+    def transmit_chunks(self, state, site, present, key, steps, chunks):
+        # transitions of the given chunks, each drawn from its own stream
+        changes = []
+        for c in chunks:
+            rng = np.random.default_rng([key, steps, c])
+            changes += self.transmit_block(state, site, present, c * self.CHUNK, min(len(state), (c + 1) * self.CHUNK), rng)
+        return changes
+
+    def transmit_parallel(self, state, site, present):
+        # hand this hour's rows to the workers, do the first share of chunks
+        # here, then collect the rest in chunk order
+        if self.buffers is None or self.owner != os.getpid():
+            self.start()
+        buffers = self.buffers
+        buffers["state"][:] = state
+        buffers["site"][:] = site
+        for j, u in enumerate(self.triggers):
+            buffers["present"][j] = present[u]
+        steps = self.model.steps
+        key = self.model.streams.key
+        shares = np.array_split(np.arange(ceil(len(state) / self.CHUNK)), len(self.procs) + 1)
+        for (proc, conn), share in zip(self.procs, shares[1:]):
+            conn.send((key, steps, share.tolist()))
+        changes = self.transmit_chunks(state, site, present, key, steps, shares[0].tolist())
+        for (proc, conn) in self.procs:
+            out = conn.recv()
+            if isinstance(out, Exception):
+                self.stop()
+                raise out
+            changes += out
+        return changes
+
+    def start(self):
+        # shared buffers and workers - 1 forked worker processes
+        # Processes that can't fork (daemonic ones like ensemble workers, or
+        # platforms without fork) do every chunk themselves, with the same result
+        population = self.model.population
+        self.buffers = {
+            "state": shared_array(population.size, population.state.dtype),
+            "site": shared_array(population.size, population.fave.dtype),
+            "present": shared_array((len(self.triggers), len(self.transmission)), np.int64),
+        }
+        self.owner = os.getpid()
+        self.procs = []
+        if multiprocessing.current_process().daemon or "fork" not in multiprocessing.get_all_start_methods():
+            return
+        context = multiprocessing.get_context("fork")
+        for i in range(self.workers - 1):
+            conn, child = context.Pipe()
+            proc = context.Process(target=chunk_worker, args=(self, child), daemon=True)
+            proc.start()
+            child.close()
+            self.procs += [(proc, conn)]
+
+    def shared(self):
+        # the rows in the shared buffers, as transmit_chunks takes them
+        buffers = self.buffers
+        return buffers["state"], buffers["site"], dict(zip(self.triggers, buffers["present"]))
+
+    def stop(self):
+        # shut the workers down; the next parallel step starts new ones
+        # (a forked copy of the model leaves its parent's workers alone)
+        if self.procs and self.owner == os.getpid():
+            for (proc, conn) in self.procs:
+                conn.send(None)
+            for (proc, conn) in self.procs:
+                proc.join()
+                conn.close()
+        self.procs = []
+        self.buffers = None
+
+
+def shared_array(shape, dtype):
+    # zeroed array in anonymous shared memory, seen by processes forked after it is made
+    count = int(np.prod(shape))
+    dtype = np.dtype(dtype)
+    return np.frombuffer(mmap.mmap(-1, max(count * dtype.itemsize, 1)), dtype=dtype, count=count).reshape(shape)
+
+
+def chunk_worker(engine, conn):
+    # worker process loop: transmit the chunks it is sent until told to stop
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            out = engine.transmit_chunks(*engine.shared(), *job)
+        except Exception as e:
+            out = e
+        conn.send(out)
+
+
+# Packed array files (checkpoints)
+# Layout: MAGIC, an 8-byte header length, a JSON header, then each array's raw
+# bytes at a 64-byte aligned offset. The header holds `meta` (anything JSON)
+# and the dtype, shape and offset of every array, so arrays can be
+# memory-mapped straight out of the file
+
+MAGIC = b"SCHEDPK1"
+ALIGN = 64
+
+def pack(path, meta, arrays):
+    # write meta (JSON-able) and a dict of numpy arrays to path
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        layout[name] = {"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"meta": meta, "arrays": layout}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    # written under a temporary name and renamed into place: arrays unpacked
+    # from the old file (memory maps of it, e.g. after restore) stay readable
+    partial = str(path) + "." + str(os.getpid())
+    with open(partial, "wb") as f:
+        f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, a in arrays.items():
+            f.seek(start + layout[name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+    os.replace(partial, path)
+
+def unpack(path):
+    # read a packed file back as (meta, arrays)
+    # arrays are copy-on-write memory maps: pages are read on first use and
+    # writes stay in memory
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(str(path) + " is not a packed array file")
+        size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(size))
+    start = -(-(len(MAGIC) + 8 + size) // ALIGN) * ALIGN
+    arrays = {}
+    for name, a in header["arrays"].items():
+        shape = tuple(a["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=a["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=a["dtype"], mode="c", offset=start + a["offset"], shape=shape)
+    return header["meta"], arrays
+
+
+# Streaming runs: sinks and stop conditions for SchedModel.run
+# A sink is called as sink(model, step, counts, events) every time run() reports;
+# counts is a copy of model.counts and events a dict of journal columns (see Log).
+# A stop condition is called as condition(model) at the same times and ends the run by returning True
+
+class CountsWriter():
+    # Sink: append one CSV row of compartment counts per report
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __call__(self, model, step, counts, events):
+        if self.file is None:
+            self.file = open(self.path, "w")
+            self.file.write(",".join(["step"] + [state.id for state in model.contagion.states]) + "\n")
+        self.file.write(",".join([str(step)] + [str(n) for n in counts.tolist()]) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Downsampler():
+    # Sink: keep one row per `factor` reports, in memory
+    # how is "mean", "max" or "last" over each window; a partial window at the end is kept too
+
+    def __init__(self, factor, how="mean"):
+        if how not in ("mean", "max", "last"):
+            raise ValueError("Unknown downsampling " + str(how))
+        self.factor = factor
+        self.how = how
+        self.steps = []
+        self.rows = []
+        self.window = []
+
+    def __call__(self, model, step, counts, events):
+        self.window += [counts]
+        self.last = step
+        if len(self.window) == self.factor:
+            self.emit()
+
+    def emit(self):
+        window = np.array(self.window)
+        if self.how == "mean":
+            self.rows += [window.mean(axis=0)]
+        elif self.how == "max":
+            self.rows += [window.max(axis=0)]
+        else:
+            self.rows += [window[-1]]
+        self.steps += [self.last]
+        self.window = []
+
+    def close(self):
+        if self.window:
+            self.emit()
+
+    def array(self):
+        # (rows x states) downsampled counts, and the step each row ends at
+        return np.array(self.rows), np.array(self.steps)
+
+
+class Extinct():
+    # Stop condition: nobody can transmit any more
+    # True once nobody is in a state others react to, nobody is in a state whose
+    # evolution leads to one, and no transition is waiting
+
+    def __init__(self):
+        self.step = None
+
+    def __call__(self, model):
+        if model.pending == 0 and not model.counts[model.contagion.spreading].any():
+            self.step = model.steps
+            return True
+        return False
 
-    def clear_sites(self):
-        for site in self.sites:
-            site.current = []
+
+class PeakPassed():
+    # Stop condition: a state's count has peaked and fallen back
+    # True once the count of state_id drops below `drop` times the highest count
+    # seen so far (and that peak was at least `least`)
+
+    def __init__(self, state_id, drop=0.5, least=1):
+        self.state_id = state_id
+        self.drop = drop
+        self.least = least
+        self.peak = 0
+        self.step = None
+
+    def __call__(self, model):
+        count = int(model.counts[model.contagion.index[self.state_id]])
+        self.peak = max(self.peak, count)
+        if self.peak >= self.least and count < self.drop * self.peak:
+            self.step = model.steps
+            return True
+        return False
 
 
 class SchedModel(Model):
     # Overall model object
     # Loads data into objects as user requires
     # Top level controls for model
-
-    def __init__(self, CALENDAR):
+    # engine="numpy" runs the contagion on ArrayEngine instead of the Mesa scheduler;
+    # workers=n spreads each of its steps over n processes (see ArrayEngine)
+    # Agent data lives in self.population; self.agents maps unique_ids to SchedAgent views
+    # Events go to self.journal; replace it with Log(model, level, capacity, ring, path) to change what is kept
+    # (the default keeps every transition in memory, growing as it goes)
+    # forward(n) steps n times, skipping quiet stretches when fast_forward is on
+    # save_schedule/load_schedule keep a sched() result on disk to skip scheduling next time
+    # All random draws come from self.streams, seeded by seed (or reset(seed))
+
+    def __init__(self, CALENDAR, engine="mesa", workers=0, seed=None):
         self.activities = {}
         self.agents = []
+        self.population = None
         self.constraints = []
         self.calendar = CALENDAR
         self.days = CALENDAR.days
@@ -284,19 +1563,44 @@ class SchedModel(Model):
     
         self.scheduler = SimultaneousActivation(self)
         self.world = World()
+        self.journal = Log(self)
+        if engine not in ("mesa", "numpy"):
+            raise ValueError("Unknown engine " + str(engine))
+        self.engine_kind = engine
+        self.engine = None
+        self.set_workers(workers)
+        self.streams = Streams(seed)
 
         self.day = 0
         self.hour = 0
         self.steps = 0
 
-        self.log = []
+        # counts[i]: agents currently in state i, kept up to date as agents change state
+        # history[t]: counts at the start of step t, for the first `recorded` rows
+        self.counts = np.zeros(0, dtype=np.int32)
+        self.history = np.zeros((0, 0), dtype=np.int32)
+        self.recorded = 0
+
+        # evolution deadlines, and the number of transitions waiting to be committed
+        self.timers = Timers()
+        self.pending = 0
+        self.fast_forward = True
+
+        # set to a Profiler to instrument step()
+        self.profiler = None
+
+        # with recording off, contagion_summary keeps no history (see run())
+        self.recording = True
+
+    HISTORY_CHUNK = 4096
 
     def compartments(self, states):
         # build a contagion object
         states = [State(name, infections, evolution) for name, (infections, evolution) in states.items()]
-        #states = {(name, State(name, infections, evolution)) for name, (infections,evolution) in states.items()}
-        # uncomment and debug
         self.contagion = Contagion(states)
+        self.counts = np.zeros(len(states), dtype=np.int32)
+        self.history = np.zeros((self.HISTORY_CHUNK, len(states)), dtype=np.int32)
+        self.recorded = 0
         
     def activity(self, name, capacity, transmission):
         # add one activity
@@ -310,7 +1614,6 @@ class SchedModel(Model):
     def constrain(self, constraints):
         # take constraint list
         for (aclass, activity, days, hours) in constraints:
-            print("Yo")
             if isinstance(days, range) and isinstance(hours,range):
                 for day in days:
                     for hour in hours:  
@@ -324,79 +1627,483 @@ class SchedModel(Model):
             else:
                 self.constraints += [Constraint(aclass, activity, days, hours)]
 
-        for constraint in self.constraints:
-            print(constraint)
-
     def populate(self, classes):
         # Create agents
-        self.agents = {}
+        # each class is a block of consecutive unique_ids: classes[name] is its range
+        self.population = Population([(name, self.activities[default], number) for name, (default, number) in classes.items()], len(self.counts))
+        self.agents = Agents(self)
+        self.world.agents = self.agents
         i = 0
         for name, (default, number) in classes.items():
-            self.classes[name] = []
-            # kind = (class_id, default activity, quantity)
-            for j in range(i, i+number):
-                a = SchedAgent(j, self, name, self.calendar, self.activities[default])
-                self.agents[j] = a
-                self.classes[name] += [a]
+            self.classes[name] = range(i, i + number)
+            i += number
+        if self.engine_kind == "mesa":
+            for a in self.agents.values():
                 self.scheduler.add(a)
-            i = j
-
-
-    def sched(self):
-        self.schedule = Schedule(self.agents, self.classes, self.activities, self.constraints, self.calendar)
-        self.schedule.sched(self.world)
-        self.schedule.show_occupancy()
+        self.counts[:] = 0
+        self.counts[0] = self.population.size
+
+    def sched(self, show=True):
+        # with the cyclic garbage collector paused: a big population needs
+        # about as many Site objects, and it would go over them again and again as they are made
+        self.schedule = Schedule(self.population, self.activities, self.constraints, self.calendar)
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.schedule.sched(self.world, self.streams.schedule)
+        finally:
+            if collecting:
+                gc.enable()
+        self.scheduled(show)
+
+    def save_schedule(self, path):
+        # write the computed schedule: the sites and every agent's site calendar,
+        # with the state sched() left the scheduling stream in; the arrays are indexed
+        # by activity and class order, so those are kept too, to check against on loading
+        pack(path, {
+            "activities": list(self.activities),
+            "classes": [[name, len(self.classes[name])] for name in self.population.classes],
+            "sites": self.site_rows(),
+            "schedule": self.streams.schedule.bit_generator.state,
+        }, {
+            "template": self.population.template,
+            "fave": self.population.fave,
+        })
+
+    def load_schedule(self, path, show=True):
+        # take a schedule written by save_schedule() instead of running sched();
+        # the model carries on exactly as if sched() had just drawn it
+        meta, arrays = unpack(path)
+        population = self.population
+        classes = [[name, len(self.classes[name])] for name in population.classes]
+        if meta.get("activities") != list(self.activities) or meta.get("classes") != classes:
+            raise ValueError("Schedule in " + str(path) + " is for other activities or classes (or another order of them)")
+        if arrays["template"].shape != (len(population.classes), self.days * self.hours) or arrays["fave"].shape != (len(self.activities), population.size):
+            raise ValueError("Schedule in " + str(path) + " doesn't fit this model")
+        self.schedule = Schedule(population, self.activities, self.constraints, self.calendar)
+        self.schedule.adopt(self.world, self.sites_from(meta["sites"]), arrays["template"], arrays["fave"])
+        self.streams.schedule.bit_generator.state = meta["schedule"]
+        self.scheduled(show)
+
+    def site_rows(self):
+        # sites as plain rows, for saving
+        return [[site.activity.label, site.site_id, site.capacity, site.occupied, site.transmission] for site in self.world.sites]
+
+    def sites_from(self, rows):
+        # sites back from site_rows()
+        sites = []
+        for (label, site_id, capacity, occupied, transmission) in rows:
+            site = Site(self.activities[label], site_id, capacity, occupied)
+            site.transmission = transmission
+            sites += [site]
+        return sites
+
+    def scheduled(self, show):
+        # get ready to step a freshly adopted schedule
+        if self.engine is not None:
+            self.engine.stop()
+        if self.engine_kind == "numpy":
+            self.engine = ArrayEngine(self, self.workers)
+        self.start_timers()
+        if show:
+            self.schedule.show_occupancy()
         #for kind in self.classes: self.schedule.show_occupancy(kind)
 
-    def contagion_summary(self):
+    def set_transmission(self, name, transmission):
+        # change an activity's transmission rate on all of its sites
+        act = self.activities[name]
+        act.transmission = transmission
+        if len(self.world.sites) == 0:
+            return
+        indices = self.schedule.occupancy.sites_of.get(act.index, np.zeros(0, dtype=np.int64))
+        for i in indices.tolist():
+            self.world.sites[i].transmission = transmission
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine.transmission[indices] = transmission
+
+    def set_workers(self, workers):
+        # number of processes each numpy engine step is spread over
+        # (0 and 1 both step in this process); any n gives the same results as any other
+        if workers and self.engine_kind != "numpy":
+            raise ValueError("Parallel steps need engine=\"numpy\"")
+        self.workers = workers
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine.workers = workers
+
+    def set_capacity(self, name, capacity):
+        # change an activity's site capacity; takes effect at the next sched()
+        self.activities[name].capacity = capacity
+
+    # Interventions
+    # Change the schedule of a running model in place: only the agents, sites
+    # and slots involved are redrawn (from the scheduling stream) or counted
+    # again, so there is no need to build a new model. The constraint list is
+    # kept in step, so a later sched() starts from the changed scenario
+
+    def move(self, aclass, activity, days, hours):
+        # class aclass does activity during days and hours (ints or ranges, as in constrain) from now on
+        population = self.population
+        k = population.classes.index(aclass)
+        act = self.activities[activity]
+        cells = [(day, hour) for day in self.span(days, self.days) for hour in self.span(hours, self.hours)]
+        slots = np.array([day * self.hours + hour for (day, hour) in cells], dtype=np.int64)
+        self.schedule.retemplate(k, slots, act.index, self.streams.schedule)
+        self.constraints = [c for c in self.constraints if not (c.agent == aclass and (c.day, c.hour) in cells)]
+        if act is not population.defaults[k]:
+            self.constraints += [Constraint(aclass, activity, day, hour) for (day, hour) in cells]
+        self.rescheduled()
+
+    def close_activity(self, name):
+        # nobody does activity name any more: classes spend its slots on their
+        # default activity instead, and it can't be moved back into
+        population = self.population
+        act = self.activities[name]
+        users = [k for k in range(len(population.classes)) if (population.template[k] == act.index).any()]
+        for k in users:
+            if population.defaults[k] is act:
+                raise ValueError("Can't close " + name + ", the default activity of class " + population.classes[k])
+        for k in users:
+            slots = np.flatnonzero(population.template[k] == act.index)
+            self.schedule.retemplate(k, slots, population.defaults[k].index, self.streams.schedule)
+        self.schedule.closed.add(act.index)
+        self.constraints = [c for c in self.constraints if c.activity != name]
+        self.rescheduled()
+
+    def close_site(self, index):
+        # close one site (by index): the agents who prefer it are drawn new
+        # sites of the same activity, with new ones opened if no others have room
+        site = self.world.sites[index]
+        act = site.activity.index
+        site.capacity = 0
+        holders = self.schedule.holders(act)
+        self.schedule.relocate(act, holders[self.population.fave[act, holders] == index], self.streams.schedule)
+        self.rescheduled()
+
+    def cut_capacity(self, name, capacity):
+        # change an activity's capacity now, on its open sites too: a random
+        # choice of each over-full site's agents are drawn new sites
+        # (raising it just leaves room; see set_capacity to change it at the next sched())
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1; use close_activity to close " + name)
+        act = self.activities[name]
+        act.capacity = capacity
+        for i in self.schedule.occupancy.sites_of.get(act.index, np.zeros(0, dtype=np.int64)).tolist():
+            if self.world.sites[i].capacity > 0:
+                self.world.sites[i].capacity = capacity
+
+        # rank each site's agents in a random order and move those past capacity
+        holders = self.schedule.holders(act.index)
+        at = self.population.fave[act.index, holders]
+        order = np.lexsort((self.streams.schedule.random(len(holders)), at))
+        rank = np.arange(len(order)) - np.searchsorted(at[order], at[order])
+        self.schedule.relocate(act.index, np.sort(holders[order[rank >= capacity]]), self.streams.schedule)
+        self.rescheduled()
+
+    def span(self, value, limit):
+        # an int or range of days or hours, checked against the calendar
+        values = value if isinstance(value, range) else [value]
+        for v in values:
+            if not 0 <= v < limit:
+                raise ValueError(str(v) + " is outside the calendar")
+        return values
+
+    def rescheduled(self):
+        # bring the engine up to date with sites opened by an intervention
+        if self.engine is not None:
+            self.engine.stop()
+            sites = self.world.sites[len(self.engine.transmission):]
+            self.engine.transmission = np.append(self.engine.transmission, [site.transmission for site in sites])
+
+    def set_transition(self, state_id, trigger, target, probability):
+        # change the probability of an existing transition of a state
+        state = self.contagion.by_id[state_id]
+        if not any(u == trigger and v == target for (u,v,w) in state.transitions):
+            raise ValueError("State " + state_id + " has no transition to " + target + " on " + trigger)
+        state.transitions = [(u, v, probability if (u == trigger and v == target) else w) for (u,v,w) in state.transitions]
+        self.recompile()
+
+    def set_evolution(self, state_id, duration):
+        # change how long a state lasts before it evolves
+        state = self.contagion.by_id[state_id]
+        if state.evolution is None:
+            raise ValueError("State " + state_id + " does not evolve")
+        state.evolution = (state.evolution[0], duration)
+        self.recompile()
+
+    def recompile(self):
+        self.contagion.compile()
+        if self.engine is not None:
+            self.engine.compile()
+        self.start_timers()
+
+    def contagion_summary(self, repeat=1):
         # reporting function
-        # log count of agents in each compartment
-
-        states = []
-        for agent in self.agents.values():
-            states += [agent.state.id]
-        counts = []
-        for S in self.contagion.states:
-            counts += [(S.id, sum([1 for state in states if state == S.id]))]
-        self.log+=[counts]
+        # log count of agents in each compartment (for `repeat` steps)
+
+        if not self.recording:
+            return
+        if self.recorded != self.steps:
+            # history[t] has to be step t: steps run without history can't be filled in later
+            raise ValueError("No history was kept after step " + str(self.recorded) + " (run with history=False); reset() the model to record it again")
+        while self.recorded + repeat > len(self.history):
+            self.history = np.concatenate([self.history, np.zeros((self.HISTORY_CHUNK, len(self.counts)), dtype=self.history.dtype)])
+        self.history[self.recorded:self.recorded + repeat] = self.counts
+        self.recorded += repeat
+
+    def trajectory(self):
+        # (steps x states) array of compartment counts recorded so far
+        return self.history[:self.recorded]
 
     def report(self):
         # print state log
-        for entry in self.log:
-            print("".join([state + ":\t"+ str(quant) + "\t" for (state, quant) in entry]))
+        ids = [state.id for state in self.contagion.states]
+        for entry in self.trajectory():
+            print("".join([state + ":\t"+ str(quant) + "\t" for (state, quant) in zip(ids, entry)]))
 
     def state_plot(self):
         # plot state counts over history
-        series = {}
-        for state in self.contagion.states:
-            series[state.id] = []
-
-        for entry in self.log:
-            for (s, q) in entry:
-                series[s] += [q]
-
-        for state in self.contagion.states:
-            plt.plot(series[state.id])
-
+        plt.plot(self.trajectory())
         plt.show()
 
+    def reset(self, seed=None):
+        # rewind to step 0 with every agent in the first state,
+        # keeping the population and the computed schedule
+        if seed is not None:
+            self.streams.seed(seed)
+        self.population.reset()
+        self.pending = 0
+        self.counts[:] = 0
+        self.counts[0] = self.population.size
+        self.recorded = 0
+        self.journal.clear()
+        self.day = 0
+        self.hour = 0
+        self.steps = 0
+        self.scheduler.steps = 0
+        self.scheduler.time = 0
+        self.start_timers()
+
     def infect(self, N, state_id):
         # choose an agent and set it to chosen state
-        for i in range(N):
-            a = random.choice(list(self.agents.values()))
-            a.next_state = [state for state in self.contagion.states if state.id == state_id][0]
+        population = self.population
+        state = self.contagion.by_id[state_id]
+        for a in self.streams.infect.integers(population.size, size=N).tolist():
+            population.next_state[a] = state.index
+            self.journal.add(Log.SEED, a, population.state[a], state.index)
+            self.pending += 1
+
+    def checkpoint(self, path):
+        # save the running simulation: the scenario, site assignments, agent
+        # states and timers, the clock, random state and compartment history
+        # (the event journal is not included)
+        population = self.population
+        meta = {
+            "calendar": [self.days, self.hours],
+            "engine": self.engine_kind,
+            "workers": self.workers,
+            "compartments": [[S.id, S.transitions, S.evolution] for S in self.contagion.states],
+            "activities": [[act.label, act.capacity, act.transmission] for act in self.activities.values()],
+            "classes": [[name, default.label, len(self.classes[name])] for name, default in zip(population.classes, population.defaults)],
+            "constraints": [[c.agent, c.activity, c.day, c.hour] for c in self.constraints],
+            "closed": [act.label for act in self.activities.values() if act.index in self.schedule.closed],
+            "sites": self.site_rows(),
+            "clock": [self.day, self.hour, self.steps],
+            "pending": self.pending,
+            "streams": self.streams.getstate(),
+        }
+        pack(path, meta, {
+            "state": population.state,
+            "next_state": population.next_state,
+            "entered": population.entered,
+            "template": population.template,
+            "fave": population.fave,
+            "history": self.trajectory(),
+        })
+
+    @classmethod
+    def restore(cls, path):
+        # rebuild a model saved by checkpoint(), ready to carry on stepping,
+        # without populate's constraints or sched()
+        meta, arrays = unpack(path)
+        model = cls(Calendar(*meta["calendar"]), engine=meta["engine"], workers=meta.get("workers", 0))
+        model.compartments(dict([(sid, ([tuple(t) for t in transitions], tuple(evolution) if evolution else None)) for (sid, transitions, evolution) in meta["compartments"]]))
+        model.activity_list(dict([(name, (capacity, transmission)) for (name, capacity, transmission) in meta["activities"]]))
+        model.populate(dict([(name, (default, number)) for (name, default, number) in meta["classes"]]))
+        model.constraints = [Constraint(*c) for c in meta["constraints"]]
+
+        model.schedule = Schedule(model.population, model.activities, model.constraints, model.calendar)
+        model.schedule.adopt(model.world, model.sites_from(meta["sites"]), arrays["template"], arrays["fave"])
+        model.schedule.closed = set([model.activities[label].index for label in meta.get("closed", [])])
+
+        states = model.contagion.states
+        model.population.state[:] = arrays["state"]
+        model.population.next_state[:] = arrays["next_state"]
+        model.population.entered[:] = arrays["entered"]
+        if model.engine_kind == "numpy":
+            model.engine = ArrayEngine(model, model.workers)
+
+        model.day, model.hour, model.steps = meta["clock"]
+        model.scheduler.steps = model.scheduler.time = model.steps
+        model.counts[:] = np.bincount(arrays["state"], minlength=len(states))
+        history = arrays["history"]
+        model.history = np.zeros((len(history) + model.HISTORY_CHUNK, len(states)), dtype=np.int32)
+        model.history[:len(history)] = history
+        model.recorded = len(history)
+        model.pending = meta["pending"]
+        model.start_timers()
+        model.streams.setstate(meta["streams"])
+        return model
+
+    def start_timers(self):
+        # evolution deadlines for every agent not already on its way to another state
+        self.timers = Timers()
+        population = self.population
+        self.add_timers(np.flatnonzero(population.state == population.next_state))
+
+    def add_timers(self, positions):
+        # evolution deadlines for agents (unique_ids) that just entered their current state
+        population = self.population
+        contagion = self.contagion
+        evolving = positions[contagion.evolves[population.state[positions]]]
+        due = population.entered[evolving] + contagion.duration[population.state[evolving]] - 1
+        for step in np.unique(due):
+            chosen = evolving[due == step]
+            self.timers.add(int(step), (chosen, population.entered[chosen]))
+
+    def commit(self):
+        # apply the transitions drawn last step; returns how many there were
+        population = self.population
+        changed = np.flatnonzero(population.state != population.next_state)
+        if len(changed):
+            n_states = len(self.counts)
+            self.counts += np.bincount(population.next_state[changed], minlength=n_states) - np.bincount(population.state[changed], minlength=n_states)
+            population.state[changed] = population.next_state[changed]
+            population.entered[changed] = self.steps
+            self.add_timers(changed)
+        if self.journal.level > 1:
+            site = population.sites(self.day * self.hours + self.hour)
+            self.journal.add_many(Log.STATE, np.arange(population.size), population.state, population.state, site)
+        return len(changed)
+
+    def evolve(self):
+        # move on the agents whose evolution deadline is this step
+        population = self.population
+        state = population.state
+        entries = [positions[population.entered[positions] == entered] for (positions, entered) in self.timers.pop(self.steps)]
+        due = np.concatenate(entries) if entries else np.zeros(0, dtype=np.int64)
+        population.next_state[due] = self.contagion.evolve_to[state[due]]
+        self.pending += len(due)
+        site = population.sites(self.day * self.hours + self.hour)
+        self.journal.add_many(Log.EVOLUTION, due, state[due], population.next_state[due], site[due])
+
+    def quiet(self):
+        # True when the next steps cannot change anyone's state until a deadline:
+        # nobody is in a transmitting state and no transition is waiting
+        return self.pending == 0 and not self.counts[self.contagion.transmitting].any()
 
     def step(self):
         # step model forward
+        # every phase ends in a lap, which times it when self.profiler is set
         #print("\nHOUR " + str(self.hour) + " OF DAY " + str(self.day) + " (STEP " + str(self.steps) + "):\n")
+        profiler = self.profiler
+        lap = no_lap if profiler is None else profiler.lap
+        t = 0 if profiler is None else time.perf_counter()
+        slot = self.day * self.hours + self.hour
         self.contagion_summary()
-        self.world.clear_sites()
-        self.scheduler.step()
-        self.hour += 1
-        self.steps += 1
-        if self.hour == self.hours:
-            self.hour = 0
-            self.day += 1
-        if self.day == self.days:
-            self.day = 0
+        self.pending = 0
+        t = lap("summary", t)
+        if self.engine is not None:
+            self.population.sites(slot)
+            t = lap("sites", t)
+            transitions = self.commit()
+            t = lap("commit", t)
+            self.evolve()
+            t = lap("evolve", t)
+            self.engine.transmit(profiler)
+            t = lap("advance", t)
+        else:
+            transitions = self.commit()
+            t = lap("commit", t)
+            self.world.load_sites(slot, self.population.state)
+            t = lap("sites", t)
+            self.scheduler.step()
+            t = lap("scheduler", t)
+            self.evolve()
+            t = lap("evolve", t)
+        self.tick(1)
+        lap("rollover", t)
+        if profiler is not None:
+            profiler.counters["transitions"] += transitions
+            profiler.occupancy(self.schedule.occupancy.counts[slot])
+            profiler.stepped(self)
+
+    def skip(self, steps):
+        # jump over `steps` quiet steps: nothing changes but the clock and history
+        if self.profiler is not None:
+            self.profiler.counters["skipped_steps"] += steps
+        self.contagion_summary(steps)
+        self.scheduler.steps += steps
+        self.scheduler.time += steps
+        self.tick(steps)
+
+    def tick(self, steps):
+        # move the clock on
+        self.steps += steps
+        t = self.day * self.hours + self.hour + steps
+        self.hour = t % self.hours
+        self.day = (t // self.hours) % self.days
+
+    def run(self, steps, every=1, sinks=[], stop=[], events=None, history=True):
+        # Generator: step the model up to `steps` times (as forward() does),
+        # yielding (step, counts) every `every` steps (every=model.hours for once a day)
+        #   for step, counts in model.run(WEEK * 10, sinks=[CountsWriter("counts.csv")], stop=[Extinct()]):
+        # sinks are called with each report, and closed (if they have close()) when the run ends
+        # stop: conditions checked at each report; the run ends as soon as one returns True
+        # events: journal event types (e.g. [Log.INFECTION]) passed to sinks; the journal's
+        #   in-memory rows are handed over and emptied at each report, so they don't pile up
+        # history=False stops the compartment history being kept, and (without events)
+        #   turns the journal into a ring for the run, so memory stays flat;
+        #   the model can't record history again until reset(), since it would have a gap
+        recording = self.recording
+        ring = self.journal.ring
+        self.recording = history
+        if not history and events is None:
+            self.journal.ring = True
+        end = self.steps + steps
+        try:
+            while self.steps < end:
+                self.forward(min(every, end - self.steps))
+                counts = self.counts.copy()
+                rows = {}
+                if events is not None:
+                    rows = self.journal.take()
+                    keep = np.isin(rows["event"], events)
+                    rows = {name: column[keep] for name, column in rows.items()}
+                for sink in sinks:
+                    sink(self, self.steps, counts, rows)
+                yield self.steps, counts
+                if any([condition(self) for condition in stop]):
+                    break
+        finally:
+            self.recording = recording
+            self.journal.ring = ring
+            for sink in sinks:
+                if hasattr(sink, "close"):
+                    sink.close()
+
+    def forward(self, steps):
+        # step the model `steps` times
+        # with fast_forward on, quiet stretches are skipped in one go, up to the
+        # next evolution deadline (hourly STATE events are not logged for them)
+        end = self.steps + steps
+        while self.steps < end:
+            if self.fast_forward and self.journal.level < 2 and self.quiet():
+                due = self.timers.next()
+                skip = (end if due is None else min(end, due)) - self.steps
+                if skip > 0:
+                    self.skip(skip)
+                    continue
+            self.step()
 
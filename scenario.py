@@ -0,0 +1,123 @@
+from model import *
+import hashlib
+import json
+import os
+
+
+# Scenario files
+#
+#   model = build(load("city.toml"), seed=1, cache="schedules")
+#   model.infect(3, "I")
+#   model.forward(WEEK * 10)
+#
+# A scenario file (JSON, or TOML on Python 3.11+) describes what test.py
+# sets up by hand: calendar, compartments, activities, classes and
+# constraints. The first compartment is the state everyone starts in.
+#
+#   calendar = {days = 7, hours = 6}
+#   seed = 1                                    # optional, see build()
+#   constraints = [
+#       # class     activity  days      hours
+#       ["class1",  "bus",    [0, 4],   1],       # [start, stop] is range(start, stop)
+#       ["class1",  "rest1",  [4, 7],   [0, 3]],
+#   ]
+#
+#   [compartments]
+#   S = {transitions = [["I", "I", 0.03]]}      # (trigger, target, probability)
+#   I = {evolution = ["R", 63]}                 # (target, duration)
+#   R = {evolution = ["S", 84]}
+#
+#   [activities]
+#   rest1 = {capacity = 3, transmission = 0.9}
+#   bus = {capacity = 20, transmission = 0.25}
+#
+#   [classes]
+#   class1 = {default = "rest1", number = 60}
+#
+# With cache=<directory>, build() keeps the schedule sched() draws in
+# <directory>/<key>.sched, where key hashes everything scheduling depends on
+# (calendar, activities, classes, constraints) and the seed. Later builds
+# with the same key load it instead of scheduling again; a loaded schedule
+# leaves the model, random streams included, exactly as a fresh sched() would.
+# Changing only the compartments keeps the key, so contagion variants of one
+# population share a schedule
+
+# Bump when Schedule.sched changes what it draws, so old cache entries are not reused
+SCHEDULE_VERSION = 3
+
+
+def load(path):
+    # read a scenario file into a dict
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("Reading TOML needs Python 3.11 or later")
+        with open(path, "rb") as f:
+            spec = tomllib.load(f)
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+    for name in ("calendar", "compartments", "activities", "classes"):
+        if name not in spec:
+            raise ValueError("Scenario " + path + " has no " + name)
+    return spec
+
+
+def span(value):
+    # a constraint's days or hours: an int, or [start, stop] for range(start, stop)
+    if isinstance(value, list):
+        if len(value) != 2:
+            raise ValueError("Ranges are written [start, stop], not " + str(value))
+        return range(*value)
+    return value
+
+
+def constraints(spec):
+    # the scenario's constraints, as SchedModel.constrain takes them
+    return [(aclass, activity, span(days), span(hours)) for (aclass, activity, days, hours) in spec.get("constraints", [])]
+
+
+def key(spec, seed):
+    # cache key of the schedule a scenario draws with a given seed
+    # activities and classes go in as ordered lists: the schedule's arrays are
+    # indexed by their order, so the same ones in another order are another schedule
+    scheduling = {
+        "calendar": spec["calendar"],
+        "activities": [[name, act] for name, act in spec["activities"].items()],
+        "classes": [[name, c] for name, c in spec["classes"].items()],
+        "constraints": spec.get("constraints"),
+    }
+    text = json.dumps([SCHEDULE_VERSION, scheduling, seed], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def build(spec, engine="mesa", workers=0, seed=None, cache=None, show=False):
+    # a scheduled SchedModel for a scenario
+    # seed (default: the scenario's own) seeds the model's random streams;
+    # cache is a directory of schedules to reuse, which needs a seed
+    if seed is None:
+        seed = spec.get("seed")
+    calendar = spec["calendar"]
+    model = SchedModel(Calendar(calendar["days"], calendar["hours"]), engine=engine, workers=workers, seed=seed)
+    model.compartments({
+        name: ([tuple(t) for t in state.get("transitions", [])], tuple(state["evolution"]) if "evolution" in state else None)
+        for name, state in spec["compartments"].items()})
+    model.activity_list({name: (act["capacity"], act["transmission"]) for name, act in spec["activities"].items()})
+    model.populate({name: (c["default"], c["number"]) for name, c in spec["classes"].items()})
+    model.constrain(constraints(spec))
+
+    if cache is None:
+        model.sched(show)
+        return model
+    if seed is None:
+        raise ValueError("Caching a schedule needs a seed")
+    path = os.path.join(cache, key(spec, seed) + ".sched")
+    if os.path.exists(path):
+        model.load_schedule(path, show)
+        return model
+    model.sched(show)
+    # pack() writes under a temporary name first, so concurrent jobs never read half a file
+    os.makedirs(cache, exist_ok=True)
+    model.save_schedule(path)
+    return model
@@ -98,6 +98,6 @@ model.constrain([
 model.sched()
 model.infect(ceil(AGENTS * 0.02), "I")
 
-for i in range(DAYS * HOURS * 100): model.step()
+model.forward(DAYS * HOURS * 100)
 
 model.state_plot()
@@ -0,0 +1,289 @@
+from model import *
+import pytest
+
+
+# Regression checks on a small seeded scenario (python -m pytest -q)
+
+DAYS = 7
+HOURS = 6
+WEEK = DAYS * HOURS
+
+
+def build(engine="mesa", seed=0, agents=120, workers=0):
+    # test.py's scenario, scheduled and seeded with a few infections
+    model = SchedModel(Calendar(DAYS, HOURS), engine=engine, workers=workers, seed=seed)
+    model.compartments({
+        "S": ([("I", "I", 0.03)], None),
+        "I": ([], ("R", WEEK * 3 // 2)),
+        "R": ([], ("S", WEEK * 2)),
+    })
+    model.activity_list({
+        "rest1": (3, 0.9), "bus": (20, 0.25), "work1": (60, 0.02), "rest2": (3, 0.9),
+        "car": (2, 0.5), "work2": (40, 0.01), "leisure": (5, 0.2), "weekend": (25, 0.01),
+    })
+    model.populate({"class1": ("rest1", agents // 2), "class2": ("rest2", agents // 2)})
+    weekdays, weekend = range(DAYS - 3), range(DAYS - 3, DAYS)
+    model.constrain([
+        ("class1", "rest1", weekdays, 0), ("class2", "rest2", weekdays, 0),
+        ("class1", "bus", weekdays, 1), ("class2", "car", weekdays, 1),
+        ("class1", "work1", weekdays, 2), ("class2", "work2", weekdays, 2),
+        ("class1", "bus", weekdays, 3), ("class2", "car", weekdays, 3),
+        ("class1", "leisure", weekdays, 4), ("class2", "leisure", weekdays, 4),
+        ("class1", "rest1", weekdays, 5), ("class2", "rest2", weekdays, 5),
+        ("class1", "rest1", weekend, range(0, 3)), ("class2", "rest2", weekend, range(0, 3)),
+        ("class1", "weekend", weekend, range(3, HOURS)), ("class2", "weekend", weekend, range(3, HOURS)),
+    ])
+    model.sched(show=False)
+    model.infect(3, "I")
+    return model
+
+
+def test_restore_carries_on_the_same_run(tmp_path):
+    for engine in ("mesa", "numpy"):
+        model = build(engine, seed=4)
+        model.forward(WEEK * 2 + 5)
+        model.checkpoint(tmp_path / "run.ck")
+        restored = SchedModel.restore(tmp_path / "run.ck")
+        model.forward(WEEK * 3)
+        restored.forward(WEEK * 3)
+        assert np.array_equal(model.trajectory(), restored.trajectory())
+
+
+def test_checkpoint_over_the_file_it_was_restored_from(tmp_path):
+    # restored arrays map the checkpoint file; writing the next checkpoint
+    # to the same path must not pull it out from under them
+    path = tmp_path / "run.ck"
+    model = build("numpy", seed=1)
+    model.forward(WEEK)
+    model.checkpoint(path)
+    restored = SchedModel.restore(path)
+    restored.forward(WEEK)
+    restored.checkpoint(path)
+    restored.forward(WEEK)
+    again = SchedModel.restore(path)
+    again.forward(WEEK)
+    model.forward(WEEK * 2)
+    assert np.array_equal(model.trajectory(), restored.trajectory())
+    assert np.array_equal(model.trajectory(), again.trajectory())
+
+
+def test_restoring_something_else_is_refused(tmp_path):
+    path = tmp_path / "bad.ck"
+    path.write_bytes(b"not a checkpoint")
+    with pytest.raises(ValueError):
+        SchedModel.restore(path)
+
+
+def test_setting_an_agents_state_keeps_the_counts():
+    for engine in ("mesa", "numpy"):
+        model = build(engine, seed=1, agents=10)
+        model.reset(1)
+        model.agents[0].state = model.contagion.by_id["I"]
+        model.forward(5)
+        assert np.array_equal(model.counts, np.bincount(model.population.state, minlength=len(model.counts)))
+        model.forward(WEEK * 2)
+        assert model.agents[0].state.id != "I"
+        assert np.array_equal(model.counts, np.bincount(model.population.state, minlength=len(model.counts)))
+
+
+def test_engines_agree_on_average():
+    # the engines draw differently, so only the replicate means should agree:
+    # infected counts within four standard errors of each other, every step after the first week
+    from ensemble import ensemble
+    infected = {}
+    for engine in ("mesa", "numpy"):
+        model = build(engine, seed=1)
+        runs = ensemble(model, 40, WEEK * 3, seed=2, processes=1, infect=[(3, "I")])
+        infected[engine] = runs.counts[:, WEEK:, runs.states.index("I")]
+    mesa, numpy = infected["mesa"], infected["numpy"]
+    assert mesa.mean() > 10
+    error = np.sqrt((mesa.var(axis=0, ddof=1) + numpy.var(axis=0, ddof=1)) / len(mesa))
+    assert (np.abs(mesa.mean(axis=0) - numpy.mean(axis=0)) <= 4 * error).all()
+
+
+def test_forwarding_is_the_same_as_stepping():
+    # skipping quiet stretches must leave the run draw for draw as it was;
+    # with transmission off for the middle four weeks the outbreak dies out,
+    # so there are quiet stretches up to the R -> S deadlines
+    for engine in ("mesa", "numpy"):
+        for seed in range(2):
+            runs = []
+            for how in ("skip", "forward", "step"):
+                model = build(engine, seed=seed)
+                model.fast_forward = how == "skip"
+                skip = model.skip
+                skipped = []
+                model.skip = lambda n: (skipped.append(n), skip(n))
+                for probability in (0.03, 0.0, 0.03):
+                    model.set_transition("S", "I", "I", probability)
+                    if how == "step":
+                        for i in range(WEEK * 4):
+                            model.step()
+                    else:
+                        model.forward(WEEK * 4)
+                    model.infect(2, "I")
+                runs += [model.trajectory().copy()]
+                assert (sum(skipped) > 0) == (how == "skip")
+            assert np.array_equal(runs[0], runs[1]) and np.array_equal(runs[0], runs[2])
+
+
+def test_profiling_leaves_the_run_alone():
+    for engine, phase in (("mesa", "scheduler"), ("numpy", "advance")):
+        model = build(engine, seed=3)
+        profiled = build(engine, seed=3)
+        profiled.profiler = Profiler()
+        model.forward(WEEK)
+        profiled.forward(WEEK)
+        assert np.array_equal(model.trajectory(), profiled.trajectory())
+        assert profiled.profiler.seconds[phase] > 0
+        assert profiled.profiler.counters["steps"] + profiled.profiler.counters["skipped_steps"] == WEEK
+
+
+def scenario_spec():
+    # a scenario file's contents: two classes, home and work
+    return {
+        "calendar": {"days": 2, "hours": 3},
+        "compartments": {"S": {"transitions": [["I", "I", 0.1]]}, "I": {"evolution": ["S", 4]}},
+        "activities": {"home": {"capacity": 2, "transmission": 0.5}, "work": {"capacity": 6, "transmission": 0.1}},
+        "classes": {"a": {"default": "home", "number": 6}, "b": {"default": "home", "number": 4}},
+        "constraints": [["a", "work", [0, 2], 1]],
+    }
+
+
+def test_constraints_on_unknown_classes_are_refused():
+    import scenario
+    spec = scenario_spec()
+    spec["constraints"] += [["c", "work", 0, 0]]
+    with pytest.raises(ValueError, match="unknown class c"):
+        scenario.build(spec, seed=3)
+
+
+def test_cached_schedule_matches_a_fresh_one(tmp_path):
+    import scenario
+    spec = scenario_spec()
+    runs = []
+    for cache in (None, tmp_path, tmp_path):
+        model = scenario.build(spec, engine="numpy", seed=3, cache=cache)
+        model.infect(2, "I")
+        model.forward(20)
+        runs += [model.trajectory().copy()]
+    assert len(list(tmp_path.iterdir())) == 1
+    assert np.array_equal(runs[0], runs[1]) and np.array_equal(runs[0], runs[2])
+
+
+def test_cache_tells_activity_orders_apart(tmp_path):
+    import scenario
+    spec = scenario_spec()
+    swapped = scenario_spec()
+    swapped["activities"] = dict(reversed(list(spec["activities"].items())))
+    assert scenario.key(spec, 3) != scenario.key(swapped, 3)
+
+    model = scenario.build(spec, seed=3, cache=tmp_path)
+    model.save_schedule(tmp_path / "plain.sched")
+    other = scenario.build(swapped, seed=3)
+    with pytest.raises(ValueError):
+        other.load_schedule(tmp_path / "plain.sched", show=False)
+
+
+def test_history_is_not_resumed_across_a_gap():
+    model = build("numpy", seed=2)
+    for step, counts in model.run(WEEK, history=False):
+        pass
+    assert model.recorded == 0
+    with pytest.raises(ValueError):
+        model.forward(5)
+    model.reset(2)
+    model.forward(5)
+    assert len(model.trajectory()) == model.steps == 5
+
+
+def test_a_run_without_history_keeps_the_journal_bounded():
+    model = build("numpy", seed=1, agents=1000)
+    model.journal = Log(model, capacity=256)
+    for step, counts in model.run(WEEK * 20, history=False):
+        pass
+    assert model.journal.dropped > 0
+    assert model.journal.capacity == 256 and not model.journal.ring
+
+
+def test_any_worker_count_gives_the_same_run(monkeypatch):
+    # small chunks, so the 400 agents are spread over several workers
+    monkeypatch.setattr(ArrayEngine, "CHUNK", 16)
+    runs = []
+    for workers in (0, 1, 2, 3):
+        model = build("numpy", seed=3, agents=400, workers=workers)
+        model.journal = Log(model, level=1)
+        model.forward(WEEK)
+        model.reset(5)
+        model.infect(3, "I")
+        model.forward(WEEK * 2)
+        events = model.journal.entries()
+        runs += [(model.trajectory().copy(), np.column_stack([events[name] for name in Log.COLUMNS]))]
+        model.engine.stop()
+    for trajectory, events in runs[1:]:
+        assert np.array_equal(runs[0][0], trajectory)
+        assert np.array_equal(runs[0][1], events)
+
+
+def check_schedule(model):
+    # everything interventions update in place matches a recount from the population arrays
+    schedule = model.schedule
+    population = model.population
+    sites = model.world.sites
+    fresh = Occupancy(population, sites, model.days, model.hours)
+    assert np.array_equal(fresh.counts.astype(np.int64), schedule.occupancy.counts.astype(np.int64))
+    assert np.array_equal(fresh.by_class, schedule.occupancy.by_class)
+
+    occupied = np.zeros(len(sites), dtype=np.int64)
+    for k in range(len(population.classes)):
+        start, stop = population.bounds[k], population.bounds[k + 1]
+        for act in np.unique(population.template[k]):
+            occupied += np.bincount(population.fave[act, start:stop], minlength=len(sites))
+    assert occupied.tolist() == [site.occupied for site in sites]
+    assert all([site.occupied <= site.capacity for site in sites])
+    assert [site.index for site in sites] == list(range(len(sites)))
+
+    agents = np.arange(population.size)
+    for slot in range(model.days * model.hours):
+        row = population.fave[population.template[population.kind, slot], agents]
+        assert np.array_equal(row, population.sites(slot))
+        order, indptr = schedule.membership.index(slot)
+        assert np.array_equal(order, np.argsort(row, kind="stable"))
+        assert np.array_equal(indptr, np.concatenate([[0], np.cumsum(np.bincount(row, minlength=len(sites)))]))
+    if model.engine is not None:
+        assert np.array_equal(model.engine.transmission, [site.transmission for site in sites])
+
+
+def test_interventions_keep_the_schedule_consistent(tmp_path):
+    for engine in ("mesa", "numpy"):
+        model = build(engine, seed=2, agents=300)
+        model.forward(WEEK)
+        check_schedule(model)
+        model.move("class1", "leisure", range(DAYS - 3, DAYS), 3)
+        check_schedule(model)
+        model.move("class2", "work1", 2, range(0, 2))
+        check_schedule(model)
+        model.forward(10)
+        model.cut_capacity("work1", 7)
+        check_schedule(model)
+        model.close_site(int(model.schedule.occupancy.sites_of[model.activities["leisure"].index][0]))
+        check_schedule(model)
+        model.set_transmission("weekend", 0.5)
+        check_schedule(model)
+        model.forward(10)
+        model.close_activity("leisure")
+        check_schedule(model)
+        model.cut_capacity("work1", 60)
+        check_schedule(model)
+        with pytest.raises(ValueError):
+            model.move("class1", "leisure", 0, 0)
+        with pytest.raises(ValueError):
+            model.close_activity("rest1")
+
+        model.forward(WEEK)
+        model.checkpoint(tmp_path / "run.ck")
+        restored = SchedModel.restore(tmp_path / "run.ck")
+        check_schedule(restored)
+        model.forward(WEEK)
+        restored.forward(WEEK)
+        assert np.array_equal(model.trajectory(), restored.trajectory())